@@ -1,15 +1,155 @@
 from collections import OrderedDict
 from sys import stderr, getsizeof
-from time import sleep
-
-import mwparserfromhell
+from threading import Event, Lock
+from time import monotonic, perf_counter, sleep
+from urllib.parse import urlparse
 
+from features import Page
 from helpers import chunker, show_progress
+import instrumentation
+from jsonstream import decode_pages
+from titles import TitleNormalizer
+
+PAGELIST = "Team Fortress Wiki:Reports/All articles/{}"
+PAGELIST_QUERY = {
+    "action": "query",
+    "format": "json",
+    "redirects": "",
+    "prop": "revisions",
+    "rvprop": "content",
+    "rvsection": "1",
+}
+
+
+class RateLimiter:
+    """Token bucket limiting the rate of requests sent to a single host.
+
+    Args:
+      interval (float): Seconds needed to refill one token
+      burst (int): Number of requests which may be sent back to back
+    """
+    def __init__(self, interval, burst=1):
+        self.interval = interval
+        self.burst = burst
+        self.tokens = burst
+        self.updated = monotonic()
+        self.resume = 0
+        self.lock = Lock()
+
+    def pause(self, seconds):
+        """Holds back all requests to the host for 'seconds', e.g. because
+        the server asked for it."""
+        with self.lock:
+            self.resume = max(self.resume, monotonic() + seconds)
+
+    def wait(self, interval=None):
+        """Blocks until a request may be sent."""
+        with self.lock:
+            if interval is not None:
+                self.interval = interval
+            if self.resume > monotonic():
+                sleep(self.resume - monotonic())
+            while True:
+                now = monotonic()
+                if self.interval > 0:
+                    self.tokens = min(
+                        self.burst,
+                        self.tokens + (now - self.updated) / self.interval
+                    )
+                else:
+                    self.tokens = self.burst
+                self.updated = now
+
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                sleep((1 - self.tokens) * self.interval)
+
+
+rate_limiters = {}
+rate_limiters_lock = Lock()
+
+title_limits = {}
+site_infos = {}
+
+
+def get_rate_limiter(api_location, interval=0):
+    """Returns the rate limiter shared by all requests to the host of
+    'api_location', no matter which API instance or thread sends them."""
+    host = urlparse(api_location).netloc
+    with rate_limiters_lock:
+        if host not in rate_limiters:
+            rate_limiters[host] = RateLimiter(interval)
+        return rate_limiters[host]
+
+
+def route_pages(titles, responses):
+    """Matches the pages of 'responses' to the requested 'titles', following
+    the normalizations and redirects the server reported.
+
+    Returns:
+      Dictionary of the form {requested title: page}. Titles the server
+      returned no page for are left out.
+    """
+    pages = {}
+    renamed = {}
+    for response in responses:
+        query = response.get("query", {})
+        for page in query.get("pages", {}).values():
+            pages[page["title"]] = page
+        for entry in query.get("normalized", []) + query.get("redirects", []):
+            renamed[entry["from"]] = entry["to"]
+
+    routed = {}
+    for title in titles:
+        target = renamed.get(title, title)
+        target = renamed.get(target, target)
+        if target in pages:
+            routed[title] = pages[target]
+    return routed
+
+
+def merge_query(response, continued):
+    """Merges a continued response into the one it continues. Pages returned
+    in both have their lists (revisions, categories, ...) joined."""
+    query = response.setdefault("query", {})
+    for key, value in continued.get("query", {}).items():
+        if key == "pages":
+            pages = query.setdefault("pages", {})
+            for pageid, page in value.items():
+                if pageid not in pages:
+                    pages[pageid] = page
+                    continue
+                for field, field_value in page.items():
+                    if isinstance(field_value, list):
+                        pages[pageid].setdefault(field, []).extend(field_value)
+                    else:
+                        pages[pageid].setdefault(field, field_value)
+        elif isinstance(value, list):
+            entries = query.setdefault(key, [])
+            entries.extend(entry for entry in value if entry not in entries)
+        else:
+            query.setdefault(key, value)
+
+    if "warnings" in continued:
+        response.setdefault("warnings", {}).update(continued["warnings"])
 
 
 class API:
-    def __init__(self, api_location, session=None, language=None):
+    TITLE_LIMIT = 50
+    TITLE_LIMIT_HIGH = 500
+    MAXLAG = 5
+    RETRY_AFTER = 5
+    LAG_RETRIES = 10
+    RETRIES = 5
+    BACKOFF = 1
+    TIMEOUT = 60
+    BLOCK_SIZE = 2**16
+
+    def __init__(self, api_location, session=None, language=None,
+                 metrics=None):
         self.api_location_raw = api_location
+        self.metrics = metrics or instrumentation.disabled
 
         if language is None:
             self.api_location = api_location
@@ -31,19 +171,165 @@ class API:
             self.api_location = self.api_location_raw.format(value)
         object.__setattr__(self, name, value)
 
+    def get(self, params, delay=None):
+        """Sends a GET request to the API once its host's rate limit allows
+        it. 'delay' sets the minimum interval between requests to the host."""
+        return self.request("GET", params, delay)
+
+    def post(self, data, delay=None, stream=False):
+        """Like API.get, but sends a POST request. See API.request for
+        'stream'."""
+        return self.request("POST", data, delay, stream)
+
+    def request(self, method, payload, delay=None, stream=False):
+        """Sends a request with 'maxlag' set. If the server is lagged or
+        overloaded, all requests to it are held back for as long as it asks
+        (Retry-After) before trying again. Transient failures (connection
+        errors, server errors, responses which aren't JSON, servers not
+        responding for TIMEOUT seconds) are retried as well, backing off
+        exponentially (see API.back_off).
+
+        Requests of offline sessions (e.g. recording.ReplaySession) aren't
+        rate limited.
+
+        If 'stream', the response is decoded while it's read (see
+        jsonstream.decode_pages) and a tuple (head, pages) is returned
+        instead of the decoded body: 'head' holds everything in front of the
+        pages and 'pages' is a generator of (page ID, page) tuples, which may
+        raise OSError or ValueError if the response breaks off."""
+        payload = dict(payload, maxlag=self.MAXLAG)
+        rate_limiter = get_rate_limiter(self.api_location)
+        offline = getattr(self.session, "offline", False)
+        lags = failures = 0
+        while True:
+            if not offline:
+                rate_limiter.wait(delay)
+            start = perf_counter()
+            try:
+                if method == "GET":
+                    response = self.session.get(
+                        self.api_location, params=payload, stream=stream,
+                        timeout=self.TIMEOUT
+                    )
+                else:
+                    response = self.session.post(
+                        self.api_location, data=payload, stream=stream,
+                        timeout=self.TIMEOUT
+                    )
+            except OSError as error:
+                # Connection errors and timeouts of requests are OSErrors
+                failures = self.back_off(rate_limiter, failures, error)
+                continue
+            self.metrics.count("requests")
+            self.metrics.count("request seconds", perf_counter() - start)
+            if not stream:
+                self.metrics.count("bytes", len(response.content))
+
+            retry_after = response.headers.get("Retry-After")
+            if response.status_code in (429, 503):
+                pass
+            elif response.status_code >= 500:
+                failures = self.back_off(
+                    rate_limiter, failures,
+                    "HTTP status {}".format(response.status_code)
+                )
+                continue
+            else:
+                try:
+                    if stream:
+                        pages = decode_pages(self.blocks(response))
+                        body = next(pages)
+                    else:
+                        body = response.json()
+                except (OSError, ValueError) as error:
+                    failures = self.back_off(rate_limiter, failures, error)
+                    continue
+                if body.get("error", {}).get("code") != "maxlag":
+                    return (body, pages) if stream else body
+
+            lags += 1
+            if lags >= self.LAG_RETRIES:
+                raise RuntimeError(
+                    "{} is lagged, giving up after {} tries".format(
+                        self.api_location, self.LAG_RETRIES
+                    )
+                )
+            retry_after = float(retry_after or self.RETRY_AFTER)
+            print("\tServer lagged, retrying in", retry_after, "s",
+                  file=stderr)
+            self.metrics.count("retries")
+            rate_limiter.pause(retry_after)
+
+    def blocks(self, response):
+        """Yields the body of a streamed response in blocks, counting its
+        bytes."""
+        for block in response.iter_content(self.BLOCK_SIZE):
+            self.metrics.count("bytes", len(block))
+            yield block
+
+    def back_off(self, rate_limiter, failures, error):
+        """Holds back all requests to the host after the failure 'error' for
+        BACKOFF * 2**failures seconds.
+
+        Returns:
+          The number of failures so far
+
+        Raises:
+          RuntimeError: If the request failed more than RETRIES times
+        """
+        if failures >= self.RETRIES:
+            raise RuntimeError("{} failed {} times, giving up: {}".format(
+                self.api_location, failures + 1, error
+            ))
+        seconds = self.BACKOFF * 2**failures
+        print("\tRequest failed ({}), retrying in {} s".format(error, seconds),
+              file=stderr)
+        self.metrics.count("retries")
+        rate_limiter.pause(seconds)
+        return failures + 1
+
+    def title_limit(self):
+        """Returns the number of titles the API accepts per request: 500 if
+        the account has the 'apihighlimits' right, otherwise 50."""
+        if self.api_location not in title_limits:
+            response = self.get({
+                "action": "query",
+                "format": "json",
+                "meta": "userinfo",
+                "uiprop": "rights",
+            })
+            rights = response.get("query", {}).get("userinfo", {}).get(
+                "rights", []
+            )
+            title_limits[self.api_location] = (
+                self.TITLE_LIMIT_HIGH if "apihighlimits" in rights
+                else self.TITLE_LIMIT
+            )
+        return title_limits[self.api_location]
+
+    def siteinfo(self):
+        """Returns the 'query' block of the wiki's general information,
+        namespaces and interwiki prefixes. Retrieved once per wiki."""
+        if self.api_location not in site_infos:
+            response = self.get({
+                "action": "query",
+                "format": "json",
+                "meta": "siteinfo",
+                "siprop": "general|namespaces|namespacealiases|interwikimap",
+            })
+            site_infos[self.api_location] = response["query"]
+        return site_infos[self.api_location]
+
+    def title_normalizer(self):
+        """Returns a titles.TitleNormalizer following the rules of the
+        wiki."""
+        return TitleNormalizer(self.siteinfo())
+
     def retrieve_pagelist(self, language):
         show_progress(0, 1, "Retrieving pagelist...")
-        all_pages = self.session.get(self.api_location, params={
-            "action": "query",
-            "format": "json",
-            "redirects": "",
-            "prop": "revisions",
-            "rvprop": "content",
-            "rvsection": "1",
-            "titles": "Team Fortress Wiki:Reports/All articles/{}".format(
-                language
-            )
-        }).json()
+        all_pages = self.get(dict(PAGELIST_QUERY, titles=PAGELIST.format(
+            language
+        )))
 
         page_query = list(all_pages["query"]["pages"].values())[0]
         page_query = page_query["revisions"][0]["*"]
@@ -51,54 +337,341 @@ class API:
         show_progress(1, 1, "Retrieved pagelist.", True)
         return language_pagelist
 
-    def retrieve_pages(self, pagetitles, data, chunk_size, delay):
+    def retrieve_pagelists(self, languages):
+        """Like API.retrieve_pagelist, but retrieves the pagelists of all
+        'languages' with as few requests as possible.
+
+        Returns:
+          Dictionary of the form {language: [title, title, ...]}
+        """
+        titles = [PAGELIST.format(language) for language in languages]
+        routed = route_pages(titles, self.retrieve_pages(
+            titles, PAGELIST_QUERY
+        ))
+        return {
+            language: [
+                page[4:-2] for page in
+                routed[title]["revisions"][0]["*"].splitlines()[1:]
+            ]
+            for language, title in zip(languages, titles)
+        }
+
+    def retrieve_pages(self, pagetitles, data, chunk_size=None, delay=None,
+                       links=False):
+        """Retrieves the given pages in chunks, yielding one response per
+        chunk. If the server cuts a response short (e.g. because of its size
+        limit), the continuations are retrieved and merged into it.
+
+        Args:
+          pagetitles (list): Titles of the pages
+          data (dict): Query parameters
+          chunk_size (int): Number of titles per request. Defaults to the
+            limit of the API (see API.title_limit)
+          delay (float): Minimum interval between requests to the host
+          links (bool): Whether to also retrieve the links and interwiki
+            links the server extracted from the pages (prop=links|iwlinks),
+            which is much smaller than retrieving and parsing their content
+
+        Returns:
+          Generator
+        """
+        if chunk_size is None:
+            chunk_size = self.title_limit()
+        data = self.page_data(data, links)
         chunks = chunker(pagetitles, chunk_size)
         for i, chunk in enumerate(chunks):
             show_progress(
                 i * chunk_size + len(chunk), len(pagetitles),
                 "Retrieving chunk '{}'-'{}'".format(chunk[0], chunk[-1])
             )
-            data["titles"] = "|".join(chunk)
-            response = self.session.post(self.api_location, data=data).json()
+            params = dict(data, titles="|".join(chunk), **{"continue": ""})
+            response = self.continue_query(params, self.post(params, delay),
+                                           delay)
             if "warnings" in response:
                 print("\tWarning\n", response["warnings"],
                       "\nChunk =", chunk,
                       file=stderr)
 
             yield response
-            sleep(delay)
+
+        show_progress(len(pagetitles), len(pagetitles),
+                      "Retrieved chunks.", True)
+
+    def stream_pages(self, pagetitles, data, chunk_size=None, delay=None,
+                     links=False):
+        """Like API.retrieve_pages, but yields the pages one at a time as
+        they're decoded from the responses (see API.request), so that no
+        response is ever held as a whole.
+
+        A response which breaks off is requested again, skipping the pages
+        already yielded. Responses the server cut short are the exception:
+        their pages are collected and merged with the continuations before
+        being yielded.
+
+        Returns:
+          Generator
+
+        Raises:
+          RuntimeError: If the API responds with an error
+        """
+        if chunk_size is None:
+            chunk_size = self.title_limit()
+        data = self.page_data(data, links)
+        chunks = chunker(pagetitles, chunk_size)
+        for i, chunk in enumerate(chunks):
+            show_progress(
+                i * chunk_size + len(chunk), len(pagetitles),
+                "Retrieving chunk '{}'-'{}'".format(chunk[0], chunk[-1])
+            )
+            params = dict(data, titles="|".join(chunk), **{"continue": ""})
+            yielded = set()
+            failures = 0
+            while True:
+                head, pages = self.post(params, delay, stream=True)
+                if "error" in head:
+                    raise RuntimeError("{} responded with an error: {}".format(
+                        self.api_location, head["error"]
+                    ))
+                try:
+                    if "continue" in head:
+                        query = head.setdefault("query", {})
+                        query["pages"] = OrderedDict(pages)
+                        pages = self.continue_query(
+                            params, head, delay
+                        )["query"]["pages"].items()
+                    for pageid, page in pages:
+                        if pageid not in yielded:
+                            yielded.add(pageid)
+                            yield page
+                except (OSError, ValueError) as error:
+                    failures = self.back_off(
+                        get_rate_limiter(self.api_location), failures, error
+                    )
+                    continue
+                break
+            if "warnings" in head:
+                print("\tWarning\n", head["warnings"],
+                      "\nChunk =", chunk,
+                      file=stderr)
 
         show_progress(len(pagetitles), len(pagetitles),
                       "Retrieved chunks.", True)
 
+    @staticmethod
+    def page_data(data, links=False):
+        """Returns the query parameters 'data' extended to retrieve the
+        pages' links, if 'links' (see API.retrieve_pages)."""
+        if not links:
+            return data
+        prop = [data["prop"]] if data.get("prop") else []
+        return dict(
+            data, prop="|".join(prop + ["links", "iwlinks"]),
+            pllimit="max", iwlimit="max",
+        )
+
+    def continue_query(self, params, response, delay=None):
+        """Retrieves the continuations of a response the server cut short
+        and merges them into it.
+
+        Returns:
+          The complete response
+        """
+        while "continue" in response:
+            continued = self.post(
+                dict(params, **response.pop("continue")), delay
+            )
+            merge_query(response, continued)
+            if "continue" in continued:
+                response["continue"] = continued["continue"]
+        return response
+
+    def retrieve_revisions(self, pagetitles, chunk_size=None, delay=None):
+        """Returns the current revision IDs of the given pages in the form
+        {title: revid}, without retrieving their content."""
+        responses = self.retrieve_pages(
+            pagetitles, data={
+                "action": "query",
+                "format": "json",
+                "redirects": "",
+                "prop": "revisions",
+                "rvprop": "ids",
+            },
+            chunk_size=chunk_size, delay=delay,
+        )
+
+        return {
+            page["title"]: page["revisions"][0]["revid"]
+            for response in responses
+            for page in response["query"]["pages"].values()
+            if "revisions" in page
+        }
+
     @staticmethod
     def format_pages(all_pages):
         """
         Returns an OrderedDict of the form
 
         {
-            title: {
-                "title": string,
-                "content": mwparserfromhell.Wikicode object,
-                "categories": [string, string, ...],
-                "displaytitle": string,
-            },
+            title: Page(
+                title=string,
+                text=string, or None if the content wasn't retrieved,
+                categories=(string, string, ...),
+                displaytitle=string, or None if it wasn't retrieved,
+            ),
             ...
         }
+
+        The pages' "content" (mwparserfromhell.Wikicode object) and
+        "features" (see features.index_features) are built on first access.
+
+        Pages retrieved without their content get the links the server
+        returned for them (see API.retrieve_pages) as "wikilinks" and
+        "wikipedia" instead, like review.collect_links does. Pages which
+        already come with those (see cache.PageCache) keep them.
         """
         formatted_pages = OrderedDict()
         for i, page in enumerate(sorted(all_pages, key=lambda k: k["title"])):
             title = page["title"]
             show_progress(i+1, len(all_pages), "Formatting "+title)
-            content = mwparserfromhell.parse(page["revisions"][0]["*"])
-            categories = [category["title"] for category in page["categories"]]
-            displaytitle = page["displaytitle"]
-            formatted_pages[title] = {
-                "title": title,
-                "content": content,
-                "categories": categories,
-                "displaytitle": displaytitle
-            }
+            categories = [
+                category["title"] for category in page.get("categories", [])
+            ]
+            displaytitle = page.get("displaytitle")
+            text = page["revisions"][0].get("*")
+            links = {}
+            if "wikilinks" in page:
+                links = {
+                    "wikilinks": page["wikilinks"],
+                    "wikipedia": page["wikipedia"],
+                }
+            elif text is None:
+                links = {
+                    "wikilinks": [
+                        link["title"] for link in page.get("links", [])
+                    ],
+                    "wikipedia": [
+                        link["*"] for link in page.get("iwlinks", [])
+                        if link["prefix"] in ("w", "wikipedia")
+                    ],
+                }
+            formatted_pages[title] = Page(
+                title, text, categories, displaytitle, **links
+            )
         show_progress(len(all_pages), len(all_pages), "Formatted all.", True)
 
         return formatted_pages
+
+
+class TitlePool:
+    """Packs the titles of several languages into full requests.
+
+    Each language's pages are retrieved in chunks of the API's title limit,
+    which usually leaves its last chunk partly empty. Instead, the pool
+    fills up such a chunk with titles of languages which haven't started
+    yet and keeps their pages until those languages take them. The pool
+    also retrieves the pagelists of all languages at once.
+
+    A pool may be shared by threads working on different languages.
+
+    Args:
+      languages (list): The languages, in the order they're started
+    """
+    def __init__(self, languages):
+        self.languages = languages
+        self.lock = Lock()
+        self.pagelists = None
+        self.started = set()
+        # {language: [(Event, titles, {title: page}), ...]}
+        self.claims = {}
+
+    def pagelist(self, language, wiki_api):
+        """Returns the pagelist of a language, retrieving those of all
+        languages the first time."""
+        with self.lock:
+            if self.pagelists is None:
+                self.pagelists = wiki_api.retrieve_pagelists(self.languages)
+            return self.pagelists[language]
+
+    def start(self, language):
+        """Marks a language as started, so that its titles aren't used to
+        fill up chunks anymore."""
+        with self.lock:
+            self.started.add(language)
+
+    def take(self, language, titles):
+        """Collects the pages among 'titles' which were retrieved along with
+        other languages' pages, waiting for requests still underway.
+
+        Returns:
+          Tuple of the list of those pages (as returned by the API) and the
+          list of titles which still have to be retrieved
+        """
+        with self.lock:
+            claims = self.claims.pop(language, [])
+        taken = {}
+        for done, _, pages in claims:
+            done.wait()
+            taken.update(pages)
+        pages = [taken[title] for title in titles if title in taken]
+        # Titles redirecting to the same page may have brought it twice
+        pages = list(OrderedDict(
+            (page["title"], page) for page in pages
+        ).values())
+        return pages, [title for title in titles if title not in taken]
+
+    def fill(self, titles, wiki_api, data, chunk_size=None, delay=None,
+             links=False):
+        """Retrieves the pages 'titles', which don't fill up a chunk of
+        'chunk_size' titles (by default the API's limit), along with titles
+        of languages which haven't started yet. See API.retrieve_pages for
+        the other arguments.
+
+        Returns:
+          List of the pages of 'titles' (as returned by the API)
+        """
+        if not titles:
+            return []
+        free = (chunk_size or wiki_api.title_limit()) - len(titles)
+        claims = []
+        done = Event()
+        with self.lock:
+            for other in self.languages:
+                if free <= 0 or self.pagelists is None:
+                    break
+                if other in self.started:
+                    continue
+                claimed = set().union(*(
+                    claim[1] for claim in self.claims.get(other, [])
+                ))
+                unclaimed = [
+                    title for title in self.pagelists[other]
+                    if title not in claimed
+                ][:free]
+                if unclaimed:
+                    claim = (done, frozenset(unclaimed), {})
+                    self.claims.setdefault(other, []).append(claim)
+                    claims.append((unclaimed, claim[2]))
+                    free -= len(unclaimed)
+
+        requested = list(titles)
+        for unclaimed, _ in claims:
+            requested.extend(unclaimed)
+        routed = {}
+        try:
+            routed = route_pages(requested, wiki_api.retrieve_pages(
+                requested, data, chunk_size=len(requested), delay=delay,
+                links=links
+            ))
+        finally:
+            # If the request failed, the other languages retrieve their
+            # titles themselves
+            for unclaimed, pages in claims:
+                pages.update(
+                    (title, routed[title]) for title in unclaimed
+                    if title in routed
+                )
+            done.set()
+        return list(OrderedDict(
+            (routed[title]["title"], routed[title])
+            for title in titles if title in routed
+        ).values())
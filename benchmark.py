@@ -0,0 +1,135 @@
+"""End-to-end benchmark of the pipeline against a local fake wiki (see
+fakewiki.py), without touching the live wikis.
+
+    python benchmark.py --pages 1000 10000 100000 --modes serial stream
+
+With --result-size and --lag-every, the fake wiki cuts responses short and
+answers with maxlag errors, so that continuations and retries are measured
+as well.
+
+For each corpus size and engine mode, main.main runs in a fresh process
+against a freshly generated corpus. Reported for each phase (as recorded by
+instrumentation.Metrics) are the time spent in it, summed over all threads
+and languages, the requests it issued and the peak RSS of the process by
+the end of it.
+"""
+import argparse
+from contextlib import redirect_stdout
+import json
+import os
+import subprocess
+import sys
+import tempfile
+from time import perf_counter
+
+import requests
+
+import fakewiki
+import instrumentation
+import main
+import review
+
+MODES = {
+    "serial": {},
+    "stream": {"window": 2},
+    "workers": {"workers": 4},
+    "processes": {"processes": os.cpu_count(), "window": 2},
+}
+
+
+def run_child(mode, url, languages):
+    """Runs the pipeline in this process and returns its measurements."""
+    main.TF2WIKI_API_LOCATION = url + "/tf2/api.php"
+    main.WIKIPEDIA_API_LOCATION = url + "/wikipedia/{}/api.php"
+    main.LANGUAGES = languages
+    main.DELAY = review.DELAY = 0
+
+    start = perf_counter()
+    phases = {}
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)
+        with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+            main.main(requests.Session(), metrics=True, **MODES[mode])
+
+        for language in languages:
+            path = "metrics{}.json".format(language.upper())
+            with open(path) as file:
+                metrics = json.load(file)
+            for name, stats in metrics["phases"].items():
+                phase = phases.setdefault(name, {
+                    "seconds": 0.0, "requests": 0, "bytes": 0,
+                    "peak_rss_mb": 0
+                })
+                for key in ("seconds", "requests", "bytes"):
+                    phase[key] += stats.get(key, 0)
+                phase["peak_rss_mb"] = max(
+                    phase["peak_rss_mb"], stats.get("peak_rss_mb") or 0
+                )
+
+    return {
+        "seconds": perf_counter() - start,
+        "peak_rss_mb": instrumentation.peak_rss(),
+        "phases": phases,
+    }
+
+
+def run(sizes, modes, languages, result_size=None, lag_every=None):
+    results = []
+    for size in sizes:
+        server = fakewiki.FakeWiki(
+            fakewiki.Corpus(size, languages), result_size=result_size,
+            lag_every=lag_every
+        ).serve()
+        for mode in modes:
+            output = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), "--child", mode,
+                 "--url", server.url, "--languages"] + languages,
+                stdout=subprocess.PIPE, check=True,
+                cwd=os.path.dirname(os.path.abspath(__file__)),
+            ).stdout
+            result = json.loads(output.decode("utf-8").splitlines()[-1])
+            result.update(pages=size, mode=mode)
+            results.append(result)
+            print_result(result)
+        server.shutdown()
+        server.server_close()
+    return results
+
+
+def print_result(result):
+    print("{} pages x {} language(s), mode '{}': {:.2f} s, peak RSS {} MB"
+          .format(result["pages"], len(result["languages"]), result["mode"],
+                  result["seconds"], result["peak_rss_mb"]))
+    for phase, stats in sorted(result["phases"].items()):
+        print("  {:<15} {:>9.2f} s {:>7} requests {:>10} KB {:>7} MB RSS"
+              .format(phase, stats["seconds"], stats["requests"],
+                      stats["bytes"] // 1024, stats["peak_rss_mb"]))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--pages", type=int, nargs="+", default=[1000])
+    parser.add_argument("--modes", nargs="+", choices=sorted(MODES),
+                        default=["serial"])
+    parser.add_argument("--languages", nargs="+", default=["de"])
+    parser.add_argument("--result-size", metavar="CHARS", type=int,
+                        help="cut responses short after this much content")
+    parser.add_argument("--lag-every", metavar="N", type=int,
+                        help="answer every N-th request with a maxlag error")
+    parser.add_argument("--json", metavar="PATH",
+                        help="also write the results to this file")
+    parser.add_argument("--child", choices=sorted(MODES),
+                        help=argparse.SUPPRESS)
+    parser.add_argument("--url", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        result = run_child(args.child, args.url, args.languages)
+        result["languages"] = args.languages
+        print(json.dumps(result))
+    else:
+        results = run(args.pages, args.modes, args.languages,
+                      args.result_size, args.lag_every)
+        if args.json:
+            with open(args.json, "w") as file:
+                json.dump(results, file, indent=2)
@@ -0,0 +1,192 @@
+import json
+import sqlite3
+from threading import Lock
+from time import time
+
+
+class PageCache:
+    """On-disk cache of retrieved pages, keyed by language, title and revision
+    ID.
+
+    Each entry holds the page as returned by the API (content, categories and
+    displaytitle) together with the simple review it got and the links the
+    stacked reviews need (see review.collect_links), so that unchanged pages
+    don't have to be parsed again. Reviews are only
+    reused if they were made by the same version of the rules, identified by
+    'fingerprint'. A cache may be shared by threads working on different
+    languages.
+    """
+    def __init__(self, path, fingerprint=""):
+        self.fingerprint = fingerprint
+        self.lock = Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS pages ("
+            "language TEXT, title TEXT, revid INTEGER, page TEXT, "
+            "review TEXT, fingerprint TEXT, "
+            "PRIMARY KEY (language, title))"
+        )
+        columns = [
+            row[1] for row in
+            self.connection.execute("PRAGMA table_info(pages)")
+        ]
+        if "links" not in columns:
+            self.connection.execute("ALTER TABLE pages ADD COLUMN links TEXT")
+
+    def load(self, language, revisions):
+        """Returns the reviews of all cached pages whose revision is still
+        current, without loading the pages themselves (see
+        PageCache.load_pages).
+
+        Args:
+          language (str): Language of the pages
+          revisions (dict): Current revision IDs of the form {title: revid}
+
+        Returns:
+          Dictionary of the form {title: review}, with review being None if
+          it was made by an older version of the rules
+        """
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT title, revid, review, fingerprint "
+                "FROM pages WHERE language = ?", (language,)
+            ).fetchall()
+        return {
+            title: None if fingerprint != self.fingerprint
+            else json.loads(review)
+            for title, revid, review, fingerprint in rows
+            if revisions.get(title) == revid
+        }
+
+    def load_pages(self, language, titles):
+        """Returns the cached pages 'titles' as returned by the API. Pages
+        whose links were stored by the current version of the rules have
+        them as "wikilinks" and "wikipedia" (see API.format_pages)."""
+        pages = []
+        with self.lock:
+            for title in titles:
+                row = self.connection.execute(
+                    "SELECT page, fingerprint, links FROM pages "
+                    "WHERE language = ? AND title = ?", (language, title)
+                ).fetchone()
+                if row is None:
+                    continue
+                page, fingerprint, links = row
+                page = json.loads(page)
+                # Links are collected by the rules' code as well
+                if fingerprint == self.fingerprint and links is not None:
+                    page.update(json.loads(links))
+                pages.append(page)
+        return pages
+
+    def store(self, language, page, review, links=None):
+        """Stores a page as returned by the API along with its review and,
+        if given, its links of the form {"wikilinks": [...], "wikipedia":
+        [...]}."""
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?, ?, ?)", (
+                    language,
+                    page["title"],
+                    page["revisions"][0]["revid"],
+                    json.dumps(page),
+                    json.dumps(review),
+                    self.fingerprint,
+                    None if links is None else json.dumps(links),
+                )
+            )
+
+    def commit(self):
+        with self.lock:
+            self.connection.commit()
+
+    def close(self):
+        with self.lock:
+            self.connection.commit()
+            self.connection.close()
+
+
+class LinkCache:
+    """Cache of resolved links, shared by all languages of a run and, if
+    stored on disk, by later runs.
+
+    Each link is stored per API location as what it leads to: an existing
+    page, a missing page or an interwiki link (see review.resolve_links).
+    Missing pages are cached as well, so dead links aren't queried again.
+    The titles pages have on other wikis (see review.retrieve_langlinks) are
+    stored per page. Entries older than 'ttl' seconds are ignored.
+    """
+    def __init__(self, path=":memory:", ttl=24*60*60):
+        self.ttl = ttl
+        self.lock = Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS links ("
+            "site TEXT, link TEXT, kind TEXT, title TEXT, resolved REAL, "
+            "PRIMARY KEY (site, link))"
+        )
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS langlinks ("
+            "site TEXT, title TEXT, langlinks TEXT, resolved REAL, "
+            "PRIMARY KEY (site, title))"
+        )
+
+    def get(self, site, links):
+        """Returns the cached resolutions of the given links in the form
+        {link: (kind, title)}."""
+        cached = {}
+        expiry = time() - self.ttl
+        with self.lock:
+            for link in links:
+                row = self.connection.execute(
+                    "SELECT kind, title FROM links "
+                    "WHERE site = ? AND link = ? AND resolved > ?",
+                    (site, link, expiry)
+                ).fetchone()
+                if row is not None:
+                    cached[link] = tuple(row)
+        return cached
+
+    def store(self, site, resolved):
+        """Stores resolutions of the form {link: (kind, title)}."""
+        now = time()
+        with self.lock:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO links VALUES (?, ?, ?, ?, ?)", [
+                    (site, link, kind, title, now)
+                    for link, (kind, title) in resolved.items()
+                ]
+            )
+            self.connection.commit()
+
+    def get_langlinks(self, site, titles):
+        """Returns the cached language links of the given pages in the form
+        {title: {language: title}}."""
+        cached = {}
+        expiry = time() - self.ttl
+        with self.lock:
+            for title in titles:
+                row = self.connection.execute(
+                    "SELECT langlinks FROM langlinks "
+                    "WHERE site = ? AND title = ? AND resolved > ?",
+                    (site, title, expiry)
+                ).fetchone()
+                if row is not None:
+                    cached[title] = json.loads(row[0])
+        return cached
+
+    def store_langlinks(self, site, langlinks):
+        """Stores language links of the form {title: {language: title}}."""
+        now = time()
+        with self.lock:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO langlinks VALUES (?, ?, ?, ?)", [
+                    (site, title, json.dumps(links), now)
+                    for title, links in langlinks.items()
+                ]
+            )
+            self.connection.commit()
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
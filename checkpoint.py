@@ -0,0 +1,98 @@
+import json
+import sqlite3
+from threading import Lock
+
+
+class Checkpoint:
+    """On-disk record of the progress of a run, so that a run which failed
+    midway can be resumed (see main.main) without retrieving and reviewing
+    everything again.
+
+    For each language, it holds the pages retrieved so far along with their
+    simple reviews, committed chunk by chunk, and the results of whole
+    phases: the pagelist, the resolved links and whether the language is
+    done. A checkpoint may be shared by threads working on different
+    languages.
+    """
+    def __init__(self, path):
+        self.lock = Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS pages ("
+            "language TEXT, title TEXT, page TEXT, review TEXT, "
+            "PRIMARY KEY (language, title))"
+        )
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS phases ("
+            "language TEXT, phase TEXT, data TEXT, "
+            "PRIMARY KEY (language, phase))"
+        )
+
+    def clear(self):
+        """Forgets all progress, e.g. when starting a new run."""
+        with self.lock:
+            self.connection.execute("DELETE FROM pages")
+            self.connection.execute("DELETE FROM phases")
+            self.connection.commit()
+
+    def load_reviews(self, language):
+        """Returns the reviews of the checkpointed pages of a language in the
+        form {title: review}, without loading the pages themselves (see
+        Checkpoint.load_pages)."""
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT title, review FROM pages WHERE language = ?",
+                (language,)
+            ).fetchall()
+        return {title: json.loads(review) for title, review in rows}
+
+    def load_pages(self, language, titles):
+        """Returns the checkpointed pages 'titles' as returned by the API."""
+        pages = []
+        with self.lock:
+            for title in titles:
+                row = self.connection.execute(
+                    "SELECT page FROM pages WHERE language = ? AND title = ?",
+                    (language, title)
+                ).fetchone()
+                if row is not None:
+                    pages.append(json.loads(row[0]))
+        return pages
+
+    def store_page(self, language, page, review):
+        """Stores a page as returned by the API along with its review. Takes
+        effect with the next commit."""
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?)", (
+                    language, page["title"], json.dumps(page),
+                    json.dumps(review),
+                )
+            )
+
+    def load(self, language, phase):
+        """Returns the saved result of a language's phase, or None."""
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT data FROM phases WHERE language = ? AND phase = ?",
+                (language, phase)
+            ).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def save(self, language, phase, data):
+        """Saves the result of a language's phase and commits."""
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO phases VALUES (?, ?, ?)",
+                (language, phase, json.dumps(data))
+            )
+            self.connection.commit()
+
+    def commit(self):
+        with self.lock:
+            self.connection.commit()
+
+    def close(self):
+        with self.lock:
+            self.connection.commit()
+            self.connection.close()
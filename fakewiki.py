@@ -0,0 +1,560 @@
+"""Offline stand-in for the MediaWiki API of the TF2 Wiki and Wikipedia.
+
+Serves a generated corpus under
+
+    http://host:port/tf2/api.php                TF2 Wiki
+    http://host:port/wikipedia/{lang}/api.php   Wikipedia in language 'lang'
+
+and supports what the pipeline uses: 'query' with titles, redirects,
+normalized titles, interwiki titles, prop=revisions|categories|info|links|
+iwlinks|langlinks and meta=siteinfo|userinfo. Like the real API, responses
+hold at most 'cllimit' categories and 'lllimit' language links and, if
+given a result size, at most that much content; the rest follows in
+continuations ('clcontinue', 'llcontinue', 'rvcontinue'). Requests with
+'maxlag' can be answered with maxlag errors. Used by benchmark.py.
+"""
+import json
+import random
+import re
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Event, Lock, Thread
+from urllib.parse import parse_qs, urlparse
+from zlib import crc32
+
+PAGELIST_TITLE = "Team Fortress Wiki:Reports/All articles/{}"
+EXTRA_INTERWIKI_PREFIXES = 200
+# Articles of the English Wikipedia are linked to up to a few hundred others
+EXTRA_WIKIPEDIAS = ["x{:03}".format(i) for i in range(300)]
+# Props which are continued: {prop: (continue parameter, limit parameter)}
+CONTINUED_PROPS = {
+    "revisions": ("rvcontinue", None),
+    "categories": ("clcontinue", "cllimit"),
+    "langlinks": ("llcontinue", "lllimit"),
+}
+LIMIT_DEFAULT = 10
+LIMIT_MAX = 500
+NAMESPACES = {0: "", 6: "File", 14: "Category"}
+LINK = re.compile(r"\[\[([^\]|]+)|\{\{see also\|([^}|]+)", flags=re.I)
+
+
+def normalize_title(title):
+    """Normalizes a title the way MediaWiki does for a first-letter case
+    wiki."""
+    title = " ".join(title.replace("_", " ").split())
+    if ":" in title:
+        namespace, name = (part.strip() for part in title.split(":", 1))
+        return "{}:{}".format(namespace[:1].upper() + namespace[1:],
+                              name[:1].upper() + name[1:])
+    return title[:1].upper() + title[1:]
+
+
+class Corpus:
+    """Deterministically generated pages.
+
+    The TF2 Wiki has the English articles 'Article 0' to 'Article {size-1}'
+    and their translations 'Article i/{lang}' for each language. Every tenth
+    article has a redirect 'Alias i'. English Wikipedia has the articles
+    'Topic 0' to 'Topic {size-1}' (with redirects 'Topic alias i'), every
+    other one of which also exists on the localized Wikipedias.
+
+    Args:
+      size (int): Number of articles per language
+      languages (list): Languages of the TF2 Wiki
+      seed (int): Seed of the generated content
+    """
+    def __init__(self, size, languages, seed=0):
+        self.size = size
+        self.languages = languages
+        self.seed = seed
+
+    def random(self, title):
+        return random.Random("{}:{}".format(self.seed, title))
+
+    @staticmethod
+    def revid(title):
+        return crc32(title.encode("utf-8")) % 10**8 + 1
+
+    def parse_article(self, title):
+        """Returns (number, language) of an article title, or None."""
+        base, _, language = title.partition("/")
+        if not base.startswith("Article "):
+            return None
+        number = base[len("Article "):]
+        if not number.isdigit() or int(number) >= self.size:
+            return None
+        if language and language not in self.languages:
+            return None
+        return int(number), language
+
+    # -------
+    # TF2 Wiki
+    # -------
+    def wiki_redirect(self, title):
+        if title.startswith("Alias "):
+            number = title[len("Alias "):]
+            if number.isdigit() and int(number) < self.size \
+                    and int(number) % 10 == 0:
+                return "Article {}".format(number)
+
+    def wiki_page(self, title):
+        """Returns the content, categories and displaytitle of a TF2 Wiki
+        page, or None if it doesn't exist."""
+        for language in self.languages:
+            if title == PAGELIST_TITLE.format(language):
+                lines = ["== All articles =="] + [
+                    "* [[Article {}/{}]]".format(i, language)
+                    for i in range(self.size)
+                ]
+                return "\n".join(lines), [], title
+
+        article = self.parse_article(title)
+        if article is None:
+            return None
+        number, language = article
+        if not language:
+            return "English article {}.".format(number), [], title
+
+        rng = self.random(title)
+        suffix = "/" + language
+        kind = rng.choice(["Weapons", "Cosmetic items", "Patches", "Maps"])
+        parts = []
+        if rng.random() < 0.2:
+            parts.append("{{DISPLAYTITLE:Article %d}}" % number)
+        if kind in ("Weapons", "Cosmetic items"):
+            parameters = ["type = {}".format(kind.lower())]
+            if rng.random() < 0.3:
+                parameters.append("name = Article {}".format(number))
+            if rng.random() < 0.7:
+                parameters.append("loadout-name = Article {}".format(number))
+            parts.append("{{Item infobox\n| " + "\n| ".join(parameters) +
+                         "\n}}")
+        if kind == "Patches":
+            parts.append(
+                "{{Patch layout\n| source = [http://example.com/%d source]\n"
+                "| updatelink = [http://example.com/update/%d update]\n}}"
+                % (number, number)
+            )
+
+        for _ in range(rng.randint(5, 25)):
+            other = rng.randrange(self.size)
+            choice = rng.random()
+            if choice < 0.5:
+                text = "[[Article {0}{1}|Article {0}]]".format(other, suffix)
+            elif choice < 0.6:
+                # Links to the same page written differently
+                text = "[[{} {}]]".format(
+                    rng.choice(["Article", "article", "Article_"]), other
+                ).replace("_ ", "_")
+            elif choice < 0.65:
+                text = "[[Alias {}]]".format(other - other % 10)
+            elif choice < 0.7:
+                text = "[[Article {}{}]]".format(other, suffix)
+            elif choice < 0.8:
+                text = "[[w:Topic {}]]".format(other)
+            elif choice < 0.85:
+                text = "[[w:{}:Topic {}|Topic]]".format(
+                    language.split("-")[0], other
+                )
+            elif choice < 0.88:
+                text = "[[w:Topic alias {}]]".format(other)
+            elif choice < 0.9:
+                text = "[[w:Topic {}]]".format(self.size + other)
+            elif choice < 0.95:
+                text = "[http://example.com/{} link] {{{{lang icon|en}}}}"\
+                    .format(other)
+            elif choice < 0.97:
+                text = "{{{{see also|Article {}{}}}}}".format(other, suffix)
+            elif choice < 0.98:
+                text = "{{w|Topic}}"
+            else:
+                text = "{{{{Main/{}}}}}".format(language)
+            parts.append("Lorem ipsum dolor sit amet {}.".format(text))
+
+        categories = ["Category:{}/{}".format(kind, language)]
+        if rng.random() < 0.1:
+            categories.append("Category:Stubs/lang")
+        if rng.random() < 0.05:
+            categories.append("Category:{}".format(kind))
+        displaytitle = title if rng.random() < 0.05 else \
+            "Article {}".format(number)
+        return "\n\n".join(parts), categories, displaytitle
+
+    def wiki_interwiki(self):
+        return ["w", "wikipedia"] + [
+            language.split("-")[0] for language in self.languages
+        ] + ["iw{}".format(i) for i in range(EXTRA_INTERWIKI_PREFIXES)]
+
+    # ---------
+    # Wikipedia
+    # ---------
+    def wikipedia_redirect(self, title):
+        if title.startswith("Topic alias "):
+            return "Topic " + title[len("Topic alias "):]
+
+    def wikipedia_page(self, language, title):
+        if not title.startswith("Topic "):
+            return None
+        number = title[len("Topic "):]
+        if not number.isdigit() or int(number) >= self.size:
+            return None
+        if language != "en" and int(number) % 2:
+            return None
+        return "Topic {}.".format(number), [], title
+
+    def wikipedia_langlinks(self, language, title):
+        """Returns the language links of a Wikipedia page to the Wikipedias
+        in the other languages which have it and, for English pages, to
+        dozens or hundreds of other Wikipedias."""
+        langlinks = [
+            {"lang": other, "*": title}
+            for other in self.wikipedia_interwiki()
+            if other != language and self.wikipedia_page(other, title)
+        ]
+        if language == "en":
+            count = self.random("langlinks:" + title).randint(
+                0, len(EXTRA_WIKIPEDIAS)
+            )
+            langlinks.extend(
+                {"lang": other, "*": "{} ({})".format(title, other)}
+                for other in EXTRA_WIKIPEDIAS[:count]
+            )
+        return sorted(langlinks, key=lambda link: link["lang"])
+
+    def wikipedia_interwiki(self):
+        return sorted({language.split("-")[0] for language in self.languages})
+
+
+class FakeWiki:
+    """Answers API queries for a corpus and counts the requests and bytes
+    it serves per site.
+
+    Args:
+      corpus (Corpus): The pages
+      result_size (int): If given, the content of the pages in a response
+        is cut off after this many characters (at least one page is
+        complete), like the real API does at $wgAPIMaxResultSize
+      lag_every (int): If given, every lag_every-th request with 'maxlag'
+        is answered with a maxlag error
+      retry_after (int): Seconds to wait after a maxlag error (Retry-After)
+    """
+    def __init__(self, corpus, result_size=None, lag_every=None,
+                 retry_after=0):
+        self.corpus = corpus
+        self.result_size = result_size
+        self.lag_every = lag_every
+        self.retry_after = retry_after
+        self.lock = Lock()
+        self.stats = {}
+        self.lag_count = 0
+
+    def count(self, site, size):
+        with self.lock:
+            stats = self.stats.setdefault(site, {"requests": 0, "bytes": 0})
+            stats["requests"] += 1
+            stats["bytes"] += size
+
+    def siteinfo(self, site, language):
+        prefixes = self.corpus.wiki_interwiki() if site == "tf2" else \
+            self.corpus.wikipedia_interwiki()
+        return {
+            "general": {"case": "first-letter"},
+            "namespaces": {
+                str(namespace): {
+                    "id": namespace, "case": "first-letter", "*": name,
+                    "canonical": name,
+                }
+                for namespace, name in NAMESPACES.items()
+            },
+            "namespacealiases": [{"id": 6, "*": "Image"}],
+            "interwikimap": [
+                dict({"prefix": prefix},
+                     **({"localinterwiki": ""} if prefix == language else {}))
+                for prefix in prefixes
+            ],
+        }
+
+    def handle(self, site, language, params):
+        if params.get("action") != "query":
+            return {"error": {"code": "badvalue"}}
+        if self.lag_every and "maxlag" in params:
+            with self.lock:
+                self.lag_count += 1
+                lagged = self.lag_count % self.lag_every == 0
+            if lagged:
+                return {"error": {
+                    "code": "maxlag", "lag": int(params["maxlag"]) + 1,
+                    "info": "Waiting for a database server",
+                }}
+
+        if params.get("meta") == "userinfo":
+            return {"query": {"userinfo": {"id": 0, "rights": ["read"]}}}
+        if params.get("meta") == "siteinfo":
+            return {"query": self.siteinfo(site, language)}
+
+        titles = params.get("titles", "").split("|")
+        if site == "tf2":
+            interwiki = set(self.corpus.wiki_interwiki())
+            get_redirect = self.corpus.wiki_redirect
+            get_page = self.corpus.wiki_page
+        else:
+            interwiki = set(self.corpus.wikipedia_interwiki()) - {language}
+            get_redirect = self.corpus.wikipedia_redirect
+
+            def get_page(title):
+                return self.corpus.wikipedia_page(language, title)
+
+        prop = params.get("prop", "").split("|")
+        # Continuations only serve the props which were cut short
+        continuing = [
+            name for name, (parameter, _) in CONTINUED_PROPS.items()
+            if parameter in params
+        ]
+        if continuing:
+            prop = continuing
+        rvprop = params.get("rvprop", "").split("|")
+        query = {"pages": {}}
+        normalized, redirects, interwiki_titles = [], [], []
+        missing_id = 0
+        for title in titles:
+            if ":" in title and title.split(":", 1)[0].strip().lower() \
+                    in interwiki:
+                interwiki_titles.append({
+                    "title": title, "iw": title.split(":", 1)[0].lower()
+                })
+                continue
+            if site != "tf2" and title.lower().startswith(language + ":"):
+                # Interwiki prefix of the wiki itself
+                normalized.append({"from": title, "to": title.split(":", 1)[1]})
+                title = title.split(":", 1)[1]
+
+            normal = normalize_title(title)
+            if normal != title:
+                normalized.append({"from": title, "to": normal})
+            title = normal
+
+            if "redirects" in params:
+                target = get_redirect(title)
+                if target is not None:
+                    redirects.append({"from": title, "to": target})
+                    title = target
+
+            page = get_page(title)
+            if page is None:
+                missing_id -= 1
+                query["pages"][str(missing_id)] = {
+                    "ns": 0, "title": title, "missing": ""
+                }
+                continue
+
+            content, categories, displaytitle = page
+            revid = self.corpus.revid(title)
+            entry = {"pageid": revid, "ns": 0, "title": title}
+            if "revisions" in prop:
+                revision = {}
+                if "ids" in rvprop:
+                    revision["revid"] = revid
+                if "content" in rvprop:
+                    revision["*"] = content
+                entry["revisions"] = [revision]
+            if "categories" in prop and categories:
+                entry["categories"] = [
+                    {"ns": 14, "title": category} for category in categories
+                ]
+            if "links" in prop or "iwlinks" in prop:
+                for link in self.links(content, interwiki):
+                    if "iw" in link and "iwlinks" in prop:
+                        entry.setdefault("iwlinks", []).append(
+                            {"prefix": link["iw"], "*": link["title"]}
+                        )
+                    elif "iw" not in link and "links" in prop:
+                        entry.setdefault("links", []).append(
+                            {"ns": 0, "title": link["title"]}
+                        )
+            if "langlinks" in prop and site != "tf2":
+                langlinks = self.corpus.wikipedia_langlinks(language, title)
+                if langlinks:
+                    entry["langlinks"] = langlinks
+            if "info" in prop:
+                entry["lastrevid"] = revid
+                if "displaytitle" in params.get("inprop", ""):
+                    entry["displaytitle"] = displaytitle
+            query["pages"][str(revid)] = entry
+
+        if normalized:
+            query["normalized"] = normalized
+        if redirects:
+            query["redirects"] = redirects
+        if interwiki_titles:
+            query["interwiki"] = interwiki_titles
+
+        continuation = {}
+        for name, (parameter, limit) in CONTINUED_PROPS.items():
+            if name not in prop:
+                continue
+            if name == "revisions":
+                token = self.cut_content(query["pages"], params.get(parameter))
+            else:
+                token = self.page(
+                    query["pages"], name, params.get(limit),
+                    params.get(parameter)
+                )
+            if token is not None:
+                continuation[parameter] = token
+        if not query["pages"]:
+            del query["pages"]
+        if continuation:
+            return {"continue": dict(continuation, **{"continue": "||"}),
+                    "query": query}
+        return {"batchcomplete": "", "query": query}
+
+    @staticmethod
+    def page(pages, name, limit, start):
+        """Cuts the lists 'name' of 'pages' to 'limit' entries in total,
+        in the order of the page IDs, starting at 'start' (a continuation
+        token) if given.
+
+        Returns:
+          The token continuing after the served entries, or None if all
+          were served
+        """
+        if limit == "max" or limit is None:
+            limit = LIMIT_MAX if limit else LIMIT_DEFAULT
+        limit = min(int(limit), LIMIT_MAX)
+        start_id, start_index = 0, 0
+        if start:
+            start_id, start_index = (int(part) for part in start.split("|"))
+
+        served = 0
+        token = None
+        for pageid in sorted(pages, key=int):
+            entries = pages[pageid].pop(name, [])
+            if int(pageid) < start_id or token is not None:
+                continue
+            offset = start_index if int(pageid) == start_id else 0
+            rest = entries[offset:]
+            taken = rest[:limit - served]
+            if taken:
+                pages[pageid][name] = taken
+            served += len(taken)
+            if len(taken) < len(rest):
+                token = "{}|{}".format(pageid, offset + len(taken))
+        return token
+
+    def cut_content(self, pages, start):
+        """Drops the revisions of 'pages' before 'start' (a continuation
+        token) and of those which don't fit into the result size anymore.
+
+        Returns:
+          The token continuing with the first dropped page, or None
+        """
+        start_id = int(start.split("|")[0]) if start else 0
+        size = 0
+        token = None
+        for pageid in sorted(pages, key=int):
+            page = pages[pageid]
+            if "revisions" not in page:
+                continue
+            if int(pageid) < start_id or token is not None:
+                del page["revisions"]
+                continue
+            revision = page["revisions"][0]
+            size += len(revision.get("*", ""))
+            if self.result_size is not None and size > self.result_size and \
+                    size > len(revision.get("*", "")):
+                token = "{}|{}".format(pageid, revision.get("revid", 0))
+                del page["revisions"]
+        return token
+
+    def response(self, path, params):
+        """Answers a request to 'path' with the (single-valued) parameters
+        'params'.
+
+        Returns:
+          Tuple (status code, headers, body)
+        """
+        parts = urlparse(path).path.strip("/").split("/")
+        if parts[0] == "tf2":
+            site, language = "tf2", None
+        elif parts[0] == "wikipedia" and len(parts) == 3:
+            site, language = "wikipedia/" + parts[1], parts[1]
+        else:
+            return 404, {}, b""
+
+        result = self.handle(site, language, params)
+        body = json.dumps(result).encode("utf-8")
+        self.count(site, len(body))
+        headers = {"Content-Type": "application/json"}
+        if result.get("error", {}).get("code") == "maxlag":
+            headers["Retry-After"] = str(self.retry_after)
+        return 200, headers, body
+
+    @staticmethod
+    def links(content, interwiki):
+        """Extracts the links of a page like the parser would, including
+        those of {{see also}}."""
+        links = []
+        for match in LINK.finditer(content):
+            title = (match.group(1) or match.group(2)).strip().lstrip(":")
+            prefix = title.split(":", 1)[0].strip().lower()
+            if ":" in title and prefix in interwiki:
+                links.append({"iw": prefix, "title": title.split(":", 1)[1]})
+            else:
+                links.append({"title": normalize_title(title)})
+        return links
+
+    def serve(self, host="127.0.0.1", port=0):
+        """Starts serving in a background thread and returns the server. Its
+        URL is available as 'server.url'."""
+        fake_wiki = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def respond(self, params):
+                status, headers, body = fake_wiki.response(self.path, {
+                    key: value[0] for key, value in params.items()
+                })
+                if status != 200:
+                    self.send_error(status)
+                    return
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                self.respond(parse_qs(
+                    urlparse(self.path).query, keep_blank_values=True
+                ))
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                self.respond(parse_qs(
+                    self.rfile.read(length).decode("utf-8"),
+                    keep_blank_values=True
+                ))
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        server.daemon_threads = True
+        server.url = "http://{}:{}".format(*server.server_address)
+        Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Serve a fake wiki corpus")
+    parser.add_argument("--pages", type=int, default=1000)
+    parser.add_argument("--languages", nargs="+", default=["de"])
+    parser.add_argument("--port", type=int, default=8000)
+    args = parser.parse_args()
+
+    server = FakeWiki(Corpus(args.pages, args.languages)).serve(port=args.port)
+    print("Serving on", server.url)
+    try:
+        Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
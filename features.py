@@ -0,0 +1,160 @@
+import sys
+
+import mwparserfromhell
+from mwparserfromhell.nodes import ExternalLink, Template, Wikilink
+
+MAGIC_WORDS = [
+    "DISPLAYTITLE",
+    "DEFAULTSORT",
+]
+
+
+def normalize_template_name(name):
+    """Normalizes a template name the way MediaWiki resolves it, so that
+    '{{item_infobox}}' and '{{Item infobox}}' end up in the same group. Magic
+    words like '{{DISPLAYTITLE:...}}' are grouped by their prefix.
+
+    Args:
+      name (str): Raw template name
+
+    Returns:
+      str
+    """
+    name = " ".join(str(name).replace("_", " ").split())
+    if ":" in name:
+        prefix = name.split(":", 1)[0].strip()
+        if prefix.upper() in MAGIC_WORDS:
+            return prefix.upper() + ":"
+    return name[:1].upper() + name[1:]
+
+
+def link_prefix(title):
+    """Returns the lowercased prefix of a link title ('category' for
+    '[[Category:Foo]]', 'w' for '[[w:Foo]]'), or an empty string for links
+    without one."""
+    if ":" in title:
+        return title.split(":", 1)[0].lower()
+    return ""
+
+
+def index_features(content):
+    """Collects everything the reviews need from a page in a single walk over
+    its Wikicode tree.
+
+    Returns a dictionary of the form
+
+    {
+        "templates": {normalized name: [Template, ...]},
+        "template_list": [Template, ...],
+        "wikilinks": {prefix: [Wikilink, ...]},
+        "wikilink_list": [Wikilink, ...],
+        "external_links": [(ExternalLink, url), ...],
+    }
+
+    with all lists in document order.
+    """
+    features = {
+        "templates": {},
+        "template_list": [],
+        "wikilinks": {},
+        "wikilink_list": [],
+        "external_links": [],
+    }
+    for node in content.ifilter(recursive=True):
+        if isinstance(node, Template):
+            name = normalize_template_name(node.name)
+            features["templates"].setdefault(name, []).append(node)
+            features["template_list"].append(node)
+        elif isinstance(node, Wikilink):
+            prefix = link_prefix(str(node.title))
+            features["wikilinks"].setdefault(prefix, []).append(node)
+            features["wikilink_list"].append(node)
+        elif isinstance(node, ExternalLink):
+            features["external_links"].append(
+                (node, str(node.url.strip_code()))
+            )
+
+    return features
+
+
+def templates(page, name):
+    """Returns all templates with the given (normalized) name on a page."""
+    return page["features"]["templates"].get(normalize_template_name(name), [])
+
+
+def wikilinks(page, *prefixes):
+    """Returns all wikilinks on a page using one of the given prefixes."""
+    return [
+        link
+        for prefix in prefixes
+        for link in page["features"]["wikilinks"].get(prefix, [])
+    ]
+
+
+class Page:
+    """A page as formatted by API.format_pages.
+
+    Pages are compact records rather than dicts, so that the pages of all
+    languages fit in memory at once. They are still read and written like
+    dicts (page["categories"]), with the fields
+
+      title, text, categories, displaytitle: as retrieved
+      content, features: the parsed Wikicode of 'text' and its
+        index_features, only built when they're first accessed, so pages
+        which are only checked for their metadata never get parsed
+      wikilinks, wikipedia: the page's links (see review.collect_links),
+        once collected
+
+    Category names and links are interned, since the same ones occur on
+    many pages, and links are kept as sorted tuples (which take less memory
+    than lists or sets of them).
+    """
+    __slots__ = (
+        "title", "text", "categories", "displaytitle", "content", "features",
+        "wikilinks", "wikipedia",
+    )
+    LINK_FIELDS = ("wikilinks", "wikipedia")
+
+    def __init__(self, title, text=None, categories=(), displaytitle=None,
+                 **fields):
+        self.title = title
+        self.text = text
+        self.categories = tuple(sys.intern(category) for category in categories)
+        self.displaytitle = displaytitle
+        for key, value in fields.items():
+            self[key] = value
+
+    def __getitem__(self, key):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            pass
+
+        if key == "content":
+            if self.text is None:
+                raise KeyError("content of '{}' wasn't retrieved".format(
+                    self.title
+                ))
+            self.content = mwparserfromhell.parse(self.text)
+            return self.content
+        elif key == "features":
+            self.features = index_features(self["content"])
+            return self.features
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        if key in self.LINK_FIELDS and value is not None:
+            value = tuple(sorted(sys.intern(link) for link in value))
+        setattr(self, key, value)
+
+    def __contains__(self, key):
+        """Whether 'key' is set, without building it."""
+        return key in self.__slots__ and hasattr(self, key)
+
+    def get(self, key, default=None):
+        """Returns 'key' if it's set, without building it."""
+        return getattr(self, key) if key in self else default
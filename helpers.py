@@ -1,3 +1,8 @@
+from itertools import islice
+from queue import Queue
+from threading import Thread
+
+
 def chunker(seq, size):
     """Splits a given sequence 'seq' into chunks of size 'size'.
 
@@ -11,8 +16,23 @@ def chunker(seq, size):
     return (seq[pos:pos + size] for pos in range(0, len(seq), size))
 
 
+def batched(iterable, size):
+    """Like chunker, but for any iterable, e.g. a generator. Items are only
+    retrieved as the batches are consumed.
+
+    Returns:
+      Generator of lists
+    """
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
 def show_progress(current_value, max_value, text, end=False):
-    percentage = int((current_value/max_value)*100)
+    percentage = int((current_value/max_value)*100) if max_value else 100
     progress = "\r[{0}{1}] {2} | {3}% | {4}{5}".format(
         "=" * (percentage//5),
         " " * (20-percentage//5),
@@ -22,3 +42,84 @@ def show_progress(current_value, max_value, text, end=False):
         "\n" if end else ""
     )
     print(progress, end="")
+
+
+def prefetch(iterable, size):
+    """Iterates over 'iterable' in a background thread, keeping at most 'size'
+    items ready in advance. Exceptions are re-raised in the consuming thread.
+
+    Args:
+      iterable (iterable): Items to be retrieved, e.g. API responses
+      size (int): Maximum number of items waiting to be consumed
+
+    Returns:
+      Generator
+    """
+    items = Queue(maxsize=size)
+    done = object()
+
+    def produce():
+        try:
+            for item in iterable:
+                items.put((item, None))
+        except Exception as error:
+            items.put((None, error))
+        else:
+            items.put((done, None))
+
+    Thread(target=produce, daemon=True).start()
+    while True:
+        item, error = items.get()
+        if error is not None:
+            raise error
+        if item is done:
+            return
+        yield item
+
+
+class Batcher:
+    """Calls 'function' in a background thread with batches of at most
+    'size' of the items added, so that they're processed while more are still
+    being discovered. The last batch may be smaller.
+
+    Args:
+      function (function): Processes a list of items and returns a result
+      size (int): Number of items per batch
+    """
+    def __init__(self, function, size):
+        self.function = function
+        self.size = size
+        self.items = Queue()
+        self.results = []
+        self.error = None
+        self.thread = Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def add(self, items):
+        self.items.put(list(items))
+
+    def run(self):
+        batch = []
+        while True:
+            items = self.items.get()
+            if items is not None:
+                batch.extend(items)
+            while len(batch) >= self.size or (batch and items is None):
+                chunk, batch = batch[:self.size], batch[self.size:]
+                if self.error is not None:
+                    continue
+                try:
+                    self.results.append(self.function(chunk))
+                except Exception as error:
+                    self.error = error
+            if items is None:
+                return
+
+    def finish(self):
+        """Processes the remaining items and returns the results of all
+        batches in order. Exceptions are re-raised in the calling thread."""
+        self.items.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+        return self.results
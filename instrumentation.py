@@ -0,0 +1,188 @@
+"""Timers and counters describing where a run spends its time.
+
+Each language gets its own Metrics, which is exported as JSON at the end of
+the run (see main.process_language).
+"""
+import cProfile
+from contextlib import contextmanager
+import json
+import os
+import pstats
+from threading import Lock, current_thread, get_ident, local, main_thread
+from time import perf_counter
+import tracemalloc
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+def peak_rss():
+    """Returns the peak resident set size of the process in MB, or None if
+    the platform can't tell."""
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // 1024
+
+
+class Metrics:
+    """Collects the time spent in each phase and rule and counts events like
+    requests, retries and bytes received.
+
+    Counted events are attributed to the phase the counting thread is in as
+    well. Phases don't nest: inside a phase, starting another one has no
+    effect.
+
+    Profiles are kept per phase and thread and merged on export. Memory is
+    traced for the whole process, so the peaks of phases are only recorded
+    in the main thread (helper threads' allocations count towards them),
+    and they're meaningless if several languages are processed at once.
+
+    Args:
+      enabled (bool): Whether to collect anything at all
+      profile_dir (str): If given, each phase is run under cProfile and its
+        statistics are written to this directory on export
+      trace_memory (bool): Whether to record each phase's peak of memory
+        allocated by Python (using tracemalloc)
+    """
+    def __init__(self, enabled=True, profile_dir=None, trace_memory=False):
+        self.enabled = enabled
+        self.profile_dir = profile_dir
+        self.trace_memory = trace_memory
+        self.lock = Lock()
+        self.current = local()
+        self.profiles = {}
+        self.data = {"phases": {}, "rules": {}, "counters": {}}
+        if trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    @contextmanager
+    def phase(self, name):
+        """Measures the time spent in the enclosed block as phase 'name'."""
+        if not self.enabled or getattr(self.current, "phase", None):
+            yield
+            return
+
+        self.current.phase = name
+        profile = None
+        if self.profile_dir is not None:
+            with self.lock:
+                profile = self.profiles.setdefault(
+                    (name, get_ident()), cProfile.Profile()
+                )
+            try:
+                profile.enable()
+            except ValueError:
+                # Another profiler is already running
+                profile = None
+        trace_memory = self.trace_memory and current_thread() is main_thread()
+        if trace_memory:
+            tracemalloc.reset_peak()
+
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            seconds = perf_counter() - start
+            if profile is not None:
+                profile.disable()
+            self.current.phase = None
+
+            with self.lock:
+                stats = self.phase_stats(name)
+                stats["calls"] += 1
+                stats["seconds"] += seconds
+                stats["peak_rss_mb"] = peak_rss()
+                if trace_memory:
+                    stats["peak_traced_mb"] = max(
+                        stats.get("peak_traced_mb", 0),
+                        tracemalloc.get_traced_memory()[1] / 2**20
+                    )
+
+    def phase_stats(self, name):
+        return self.data["phases"].setdefault(name, {
+            "calls": 0, "seconds": 0.0
+        })
+
+    def iterate(self, name, iterable):
+        """Iterates over 'iterable', measuring the time spent retrieving each
+        item as phase 'name'."""
+        iterator = iter(iterable)
+        while True:
+            with self.phase(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def count(self, name, value=1):
+        """Adds 'value' to the counter 'name', both overall and for the
+        current phase."""
+        if not self.enabled:
+            return
+        phase = getattr(self.current, "phase", None)
+        with self.lock:
+            counters = self.data["counters"]
+            counters[name] = counters.get(name, 0) + value
+            if phase is not None:
+                stats = self.phase_stats(phase)
+                stats[name] = stats.get(name, 0) + value
+
+    def rule(self, name, seconds):
+        """Records a single call of the review 'name'."""
+        if not self.enabled:
+            return
+        with self.lock:
+            stats = self.data["rules"].setdefault(name, {
+                "calls": 0, "seconds": 0.0
+            })
+            stats["calls"] += 1
+            stats["seconds"] += seconds
+
+    def merge(self, data):
+        """Adds the data of another Metrics, e.g. one of a worker process."""
+        if not self.enabled:
+            return
+        with self.lock:
+            for section in ("phases", "rules"):
+                for name, stats in data[section].items():
+                    own = self.data[section].setdefault(name, {})
+                    for key, value in stats.items():
+                        if key.startswith("peak_"):
+                            own[key] = value if own.get(key) is None \
+                                else max(own[key], value or 0)
+                        else:
+                            own[key] = own.get(key, 0) + value
+            for name, value in data["counters"].items():
+                counters = self.data["counters"]
+                counters[name] = counters.get(name, 0) + value
+
+    def export(self, path, **extra):
+        """Writes all metrics (and the given extra fields) as JSON to 'path'
+        and the profiles of the phases next to them, if any."""
+        if not self.enabled:
+            return
+        with self.lock:
+            data = dict(extra, **self.data)
+            with open(path, "w") as file:
+                json.dump(data, file, indent=2, sort_keys=True)
+
+            if self.profile_dir is not None:
+                os.makedirs(self.profile_dir, exist_ok=True)
+                prefix = os.path.splitext(os.path.basename(path))[0]
+                merged = {}
+                for (name, _), profile in self.profiles.items():
+                    if name in merged:
+                        merged[name].add(profile)
+                    else:
+                        merged[name] = pstats.Stats(profile)
+                for name, stats in merged.items():
+                    stats.dump_stats(os.path.join(
+                        self.profile_dir,
+                        "{}-{}.prof".format(prefix, name.replace(" ", "_"))
+                    ))
+
+
+disabled = Metrics(enabled=False)
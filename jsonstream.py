@@ -0,0 +1,227 @@
+"""Incremental decoding of API responses.
+
+Decoding a response with 'rvprop=content' at once requires its whole body,
+both as bytes and as text, next to all of its decoded pages. decode_pages
+instead reads the body block by block and decodes the entries of
+'query.pages' one at a time, so that each page can be handed on as soon as
+it's complete and only the page being decoded is held as text.
+"""
+import codecs
+import json
+import re
+
+WHITESPACE = re.compile(r"[ \t\n\r]*")
+STRUCTURE = re.compile(r'["{}\[\]]')
+STRING_END = re.compile(r'["\\]')
+SCALAR = re.compile(r"[-+.0-9A-Za-z]*")
+decoder = json.JSONDecoder()
+
+
+def scan(text, start, state):
+    """Scans 'text' from 'start' for the end of an object, array or string,
+    skipping over everything in strings.
+
+    Args:
+      text (str): Part of a JSON body
+      start (int): Where to start scanning
+      state (tuple): (depth, in string, after backslash) at 'start'; (0,
+        False, False) at the start of the value
+
+    Returns:
+      Tuple (state, end): the state at the end of 'text' to continue
+      scanning the next part with, and the index after the end of the
+      value, or None if it isn't in 'text'
+    """
+    depth, in_string, escaped = state
+    index = start + 1 if escaped else start
+    while True:
+        if in_string:
+            match = STRING_END.search(text, index)
+            if match is None:
+                return (depth, True, False), None
+            index = match.end()
+            if match.group() == "\\":
+                if index == len(text):
+                    return (depth, True, True), None
+                index += 1
+                continue
+            in_string = False
+            if depth == 0:
+                return (depth, False, False), index
+        else:
+            match = STRUCTURE.search(text, index)
+            if match is None:
+                return (depth, False, False), None
+            index = match.end()
+            character = match.group()
+            if character == '"':
+                in_string = True
+            elif character in "{[":
+                depth += 1
+            else:
+                depth -= 1
+                if depth == 0:
+                    return (depth, False, False), index
+
+
+class Reader:
+    """Reads JSON values from a body arriving in blocks of bytes, keeping
+    only the part which wasn't decoded yet."""
+    def __init__(self, blocks):
+        self.blocks = iter(blocks)
+        self.utf8 = codecs.getincrementaldecoder("utf-8")()
+        self.buffer = ""
+        self.position = 0
+        self.finished = False
+
+    def next_text(self):
+        """Returns the next block as text, or None if the body is over."""
+        if self.finished:
+            return None
+        text = ""
+        while not text:
+            block = next(self.blocks, None)
+            if block is None:
+                text = self.utf8.decode(b"", final=True)
+                self.finished = True
+                break
+            text = self.utf8.decode(block)
+        return text
+
+    def read(self):
+        """Appends the next block to the buffer.
+
+        Returns:
+          False if the body is over
+        """
+        text = self.next_text()
+        if text is None:
+            return False
+        self.buffer = self.buffer[self.position:] + text
+        self.position = 0
+        return True
+
+    def complete(self):
+        """Reads on until the buffer holds all of the object, array or string
+        starting at the current position (or the body is over), so that it's
+        decoded once instead of again after each block."""
+        state, end = scan(self.buffer, self.position, (0, False, False))
+        if end is not None:
+            return
+        parts = [self.buffer[self.position:]]
+        while end is None:
+            text = self.next_text()
+            if text is None:
+                break
+            parts.append(text)
+            state, end = scan(text, 0, state)
+        self.buffer = "".join(parts)
+        self.position = 0
+
+    def peek(self):
+        """Returns the next character which isn't whitespace, or an empty
+        string at the end of the body."""
+        while True:
+            self.position = WHITESPACE.match(
+                self.buffer, self.position
+            ).end()
+            if self.position < len(self.buffer):
+                return self.buffer[self.position]
+            if not self.read():
+                return ""
+
+    def expect(self, characters):
+        """Consumes the next character, which has to be one of
+        'characters'.
+
+        Returns:
+          The character
+
+        Raises:
+          ValueError: If it's another one
+        """
+        character = self.peek()
+        if not character or character not in characters:
+            raise ValueError("Expected one of '{}' at '{}'".format(
+                characters, self.buffer[self.position:self.position + 20]
+            ))
+        self.position += 1
+        return character
+
+    def value(self):
+        """Decodes the next value.
+
+        Raises:
+          ValueError: If it isn't valid JSON
+        """
+        if self.peek() in ("{", "[", '"'):
+            self.complete()
+        else:
+            # A number or literal at the end of the buffer may go on in the
+            # next block ('1e' is decoded as 1)
+            while SCALAR.match(self.buffer, self.position).end() == len(
+                self.buffer
+            ) and self.read():
+                pass
+        value, self.position = decoder.raw_decode(self.buffer, self.position)
+        return value
+
+    def members(self):
+        """Iterates over the members of the object starting at the next
+        character, yielding the name of each. The caller has to consume its
+        value before continuing."""
+        self.expect("{")
+        if self.peek() == "}":
+            self.position += 1
+            return
+        while True:
+            name = self.value()
+            if not isinstance(name, str):
+                raise ValueError("Expected a member name")
+            self.expect(":")
+            yield name
+            if self.expect(",}") == "}":
+                return
+
+
+def decode_pages(blocks):
+    """Decodes a 'query' response arriving in 'blocks' (bytes), yielding
+    the head of the response first and then each entry of 'query.pages' as
+    a tuple (page ID, page) as soon as it's decoded.
+
+    The head is a dictionary of everything in the response up to the pages:
+    'continue', 'warnings' or 'error', as the API places those in front of
+    its results. Once all pages are consumed, the rest of the response
+    (e.g. 'query.normalized') is added to it.
+
+    Args:
+      blocks (iterable): The body of the response in parts
+
+    Returns:
+      Generator
+
+    Raises:
+      ValueError: If the body isn't valid JSON
+    """
+    reader = Reader(blocks)
+    head = {}
+    started = False
+    for name in reader.members():
+        if name != "query":
+            head[name] = reader.value()
+            continue
+
+        if not started:
+            started = True
+            yield head
+        query = head.setdefault("query", {})
+        for query_name in reader.members():
+            if query_name != "pages" or reader.peek() != "{":
+                query[query_name] = reader.value()
+                continue
+            for pageid in reader.members():
+                yield pageid, reader.value()
+    if reader.peek():
+        raise ValueError("Extra data after the response")
+    if not started:
+        yield head
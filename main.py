@@ -1,53 +1,611 @@
+import argparse
+from collections import OrderedDict
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+from itertools import chain
+import os
+from time import perf_counter
+
 import requests
 
 import api
+import cache
+import checkpoint
+import instrumentation
+import recording
+import results
 import review
+from helpers import batched, chunker, prefetch
 
 TF2WIKI_API_LOCATION = "https://wiki.teamfortress.com/w/api.php"
 WIKIPEDIA_API_LOCATION = "https://{}.wikipedia.org/w/api.php"
-CHUNK_SIZE = 50
+CHUNK_SIZE = None  # Titles per request; None uses the API's limit
+BATCH_SIZE = 50
 DELAY = 0.5
 LANGUAGES = ["ar", "cs", "da", "de", "es", "fi", "fr", "hu", "it", "ja", "ko",
              "nl", "no", "pl", "pt", "pt-br", "ro", "ru", "sv", "tr", "zh-hans",
              "zh-hant"]
 
 
-def main(session):
-    wiki_api = api.API(TF2WIKI_API_LOCATION, session=session)
-    for language in LANGUAGES:
-        print("Operations for language '{}'".format(language))
-        wikipedia_api = api.API(WIKIPEDIA_API_LOCATION, session=session, language="en")
-        pagetitles = wiki_api.retrieve_pagelist(language)
-        all_pages = wiki_api.retrieve_pages(
-            pagetitles, data={
-                "action": "query",
-                "format": "json",
-                "redirects": "",
-                "prop": "categories|info|revisions",
-                "cllimit": "max",
-                "inprop": "displaytitle",
-                "rvprop": "content",
-            },
-            chunk_size=CHUNK_SIZE, delay=DELAY,
+def main(session, cache_path=None, workers=1, window=None, processes=None,
+         batch_size=BATCH_SIZE, rules=None, link_cache_path=":memory:",
+         record_path=None, replay_path=None, metrics=False, profile_dir=None,
+         trace_memory=False, server_links=False, checkpoint_path=None,
+         resume=False, stream=False, pack_titles=False, langlinks=False):
+    """Reviews all languages and saves the results.
+
+    Args:
+      session (requests.Session): Session used for all API requests
+      cache_path (str): Location of the page cache. If given, only pages
+        whose revision changed since the last run are retrieved and reviewed
+        again.
+      workers (int): Number of languages processed at the same time. Requests
+        to each host are rate limited across all of them.
+      window (int): If given, stream pages through parsing and reviewing
+        with at most this many chunks retrieved in advance (see
+        process_language)
+      processes (int): If given, parse and simple-review pages in this many
+        worker processes, 'batch_size' pages at a time
+      batch_size (int): Number of pages handed to a worker process at once
+      rules (list): Names of the reviews to run; all if None. Page content
+        is only retrieved and parsed if one of them needs it.
+      link_cache_path (str): Location of the cache of resolved links, which
+        is shared by all languages. Kept in memory by default.
+      record_path (str): If given, all API traffic is recorded to this
+        archive (see recording.RecordingSession)
+      replay_path (str): If given, API responses are replayed from this
+        archive instead of being requested, without any delays. Runs
+        recorded with 'workers' > 1 can't be replayed (see recording).
+      metrics (bool): Whether to export timings and counters of each
+        language's phases, requests and reviews to 'metrics{LANG}.json'
+      profile_dir (str): If given, profile each phase with cProfile and save
+        the statistics to this directory (implies 'metrics')
+      trace_memory (bool): Whether to record each phase's peak of memory
+        allocated by Python (implies 'metrics'). Like 'profile_dir', this
+        requires 'workers' to be 1, since both measure the whole process.
+      server_links (bool): Whether to retrieve the links the stacked reviews
+        need from the API instead of parsing them from the pages' content,
+        if no review needs the content anyway. Note that the server's links
+        include those added by templates.
+      checkpoint_path (str): If given, the progress of each language (the
+        retrieved and reviewed pages, chunk by chunk, and the resolved
+        links) is recorded in this file
+      resume (bool): Whether to continue the run recorded at
+        'checkpoint_path' instead of starting over. Languages which were
+        done are skipped, and of the others only missing pages are
+        retrieved and reviewed. Use the same options as for that run.
+      stream (bool): Whether to decode responses while they're read and
+        review their pages 'batch_size' at a time as they come in (see
+        API.stream_pages), instead of holding whole responses. Keeps memory
+        low even with many titles per request.
+      pack_titles (bool): Whether to retrieve the pagelists of all languages
+        at once and fill up each language's last, partly empty chunk of
+        titles with titles of the languages after it (see api.TitlePool)
+      langlinks (bool): Whether to resolve the Wikipedia links of all
+        languages at once on the English Wikipedia, along with the titles of
+        their targets in the other languages (see review.Langlinks), which
+        wrong_wikipedia_links then suggests. The stacked reviews of all
+        languages wait until all languages' pages are retrieved.
+    """
+    if workers > 1 and (profile_dir is not None or trace_memory):
+        raise ValueError(
+            "Profiling and tracing memory need a single worker, since other "
+            "languages' threads would distort their measurements"
         )
 
-        all_pages = [
-            page
-            for pages in all_pages
-            for page in pages["query"]["pages"].values()
+    if replay_path is not None:
+        session = recording.ReplaySession(replay_path)
+    elif record_path is not None:
+        session = recording.RecordingSession(session, record_path)
+
+    page_cache = None
+    if cache_path is not None:
+        page_cache = cache.PageCache(cache_path, review.fingerprint())
+
+    link_cache = cache.LinkCache(link_cache_path)
+
+    progress = None
+    if checkpoint_path is not None:
+        progress = checkpoint.Checkpoint(checkpoint_path)
+        if not resume:
+            progress.clear()
+
+    process_pool = None
+    if processes is not None:
+        process_pool = ProcessPoolExecutor(max_workers=processes)
+
+    metrics_options = None
+    if metrics or profile_dir is not None or trace_memory:
+        metrics_options = {
+            "profile_dir": profile_dir, "trace_memory": trace_memory
+        }
+
+    options = {
+        "page_cache": page_cache,
+        "window": window,
+        "executor": process_pool,
+        "batch_size": batch_size,
+        "rules": rules,
+        "link_cache": link_cache,
+        "metrics_options": metrics_options,
+        "server_links": server_links,
+        "progress": progress,
+        "stream": stream,
+        "title_pool": api.TitlePool(LANGUAGES) if pack_titles else None,
+        "langlinks": review.Langlinks(LANGUAGES) if langlinks else None,
+    }
+    if workers > 1:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [
+                executor.submit(process_language, language, session, **options)
+                for language in LANGUAGES
+            ]
+            completions = [future.result() for future in futures]
+    else:
+        completions = [
+            process_language(language, session, **options)
+            for language in LANGUAGES
         ]
 
-        pages = wiki_api.format_pages(all_pages)
-        simple_reviewed_pages = review.simple_review(pages, language)
-        stacked_review_pages = review.stacked_review(pages, language, wiki_api, wikipedia_api)
-        reviews = review.merge_dicts(simple_reviewed_pages, stacked_review_pages)
-        review.save_file(reviews, language)
-        print("'{}' done.".format(language))
+    if langlinks:
+        options["langlinks"].resolve(api.API(
+            WIKIPEDIA_API_LOCATION, session=session, language="en"
+        ), link_cache)
+        completions = [
+            complete for complete in completions if complete is not None
+        ]
+        if workers > 1:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                futures = [
+                    executor.submit(complete) for complete in completions
+                ]
+                for future in futures:
+                    future.result()
+        else:
+            for complete in completions:
+                complete()
 
+    if process_pool is not None:
+        process_pool.shutdown()
+
+    if page_cache is not None:
+        page_cache.close()
+    if progress is not None:
+        progress.close()
+    link_cache.close()
+    if replay_path is not None or record_path is not None:
+        session.close()
     print("All done.")
 
+
+def page_query(rules=None, server_links=False):
+    """Returns the query parameters for retrieving pages for the reviews in
+    'rules' (all if None) and whether to retrieve their links along with them
+    (see API.retrieve_pages). Only what the reviews need is retrieved: if
+    'server_links', the links are only retrieved if the content isn't."""
+    fields = review.needed_fields(rules)
+    links = server_links and "links" in fields and "content" not in fields
+    content = "content" in fields or ("links" in fields and not links)
+
+    data = {
+        "action": "query",
+        "format": "json",
+        "redirects": "",
+        "prop": "revisions",
+        "rvprop": "content|ids" if content else "ids",
+    }
+    if "categories" in fields:
+        data.update(prop=data["prop"] + "|categories", cllimit="max")
+    if "displaytitle" in fields:
+        data.update(prop=data["prop"] + "|info", inprop="displaytitle")
+    return data, links
+
+
+def parse_and_review(raw_pages, language, skip=(), release=False,
+                     rules=None, metrics=None):
+    """Formats and simple-reviews pages as returned by the API.
+
+    Args:
+      raw_pages (list): Pages as returned by the API
+      language (str): Language of the pages
+      skip (set): Titles of pages which don't need a simple review
+      release (bool): Whether to drop the parsed content of the pages after
+        reviewing them, keeping only what the stacked reviews need
+      rules (list): Names of the reviews to run; all if None
+      metrics (instrumentation.Metrics): Records the time spent in each step
+
+    Returns:
+      Tuple of the formatted pages and their simple reviews
+    """
+    metrics = metrics or instrumentation.disabled
+    with metrics.phase("format"):
+        pages = api.API.format_pages(raw_pages)
+    to_review = OrderedDict(
+        (title, page) for title, page in pages.items() if title not in skip
+    )
+
+    # Parsing would happen in the first review touching the content anyway,
+    # but is measured separately this way
+    if metrics.enabled:
+        with metrics.phase("parse"):
+            for page in to_review.values():
+                if review.needs_content(page, language, rules):
+                    page["features"]
+
+    with metrics.phase("simple review"):
+        reviews = review.simple_review(to_review, language, rules, metrics)
+    if release:
+        links = "links" in review.needed_fields(rules)
+        with metrics.phase("release"):
+            for page in pages.values():
+                review.release_content(page, links)
+    return pages, reviews
+
+
+def review_batch(raw_pages, language, skip, rules, measure):
+    """Runs parse_and_review for a batch of pages in a worker process and
+    returns its results along with the worker's metrics data, if
+    'measure'."""
+    metrics = instrumentation.Metrics(enabled=measure)
+    pages, reviews = parse_and_review(
+        raw_pages, language, skip, True, rules, metrics
+    )
+    return pages, reviews, metrics.data if measure else None
+
+
+def process_language(language, session, page_cache=None, window=None,
+                     executor=None, batch_size=BATCH_SIZE, rules=None,
+                     link_cache=None, metrics_options=None, server_links=False,
+                     progress=None, stream=False, title_pool=None,
+                     langlinks=None):
+    """Retrieves, reviews and saves all pages of a single language.
+
+    If 'window' is given, pages are streamed: at most 'window' chunks are
+    retrieved ahead while earlier ones are parsed and reviewed, and each
+    page's parsed content is dropped once its simple review and links are
+    done.
+
+    If 'executor' (a concurrent.futures.ProcessPoolExecutor) is given, pages
+    are parsed and simple-reviewed in its worker processes in batches of
+    'batch_size' pages. Workers only send back the reviews and the links the
+    stacked reviews need, not the parsed content.
+
+    Only the reviews in 'rules' are run, if given. Page content is then only
+    retrieved if one of them needs it.
+
+    Links are resolved through 'link_cache' (a cache.LinkCache), if given.
+
+    If 'metrics_options' is given, the time spent in each phase and review
+    and the requests sent are exported to 'metrics{LANG}.json' (see
+    instrumentation.Metrics for the options).
+
+    If 'server_links' and no review needs the content of the pages, the
+    links the stacked reviews need are retrieved along with the pages
+    instead of being parsed from their content.
+
+    If 'progress' (a checkpoint.Checkpoint) is given, the pagelist, each
+    chunk of retrieved and simple-reviewed pages and the resolved links are
+    recorded in it, and whatever it already holds isn't retrieved or
+    reviewed again. Checkpointed pages still have to be parsed again if the
+    stacked reviews need their links.
+
+    If 'stream', pages are decoded one at a time while the responses are
+    read and parsed and reviewed in batches of 'batch_size' pages, dropping
+    their content afterwards like with 'window'.
+
+    If 'title_pool' (an api.TitlePool) is given, the pagelist is retrieved
+    through it, and so is the last chunk of pages, filled up with titles of
+    languages which haven't started yet. Pages retrieved that way by
+    earlier languages are taken from it.
+
+    If 'langlinks' (a review.Langlinks shared by all languages) is given,
+    the pages' Wikipedia links are added to it and a function completing the
+    language (resolving the other links, running the stacked reviews and
+    saving the results) is returned instead, to be called once the links of
+    all languages were resolved.
+    """
+    if title_pool is not None:
+        title_pool.start(language)
+    if progress is not None and progress.load(language, "done"):
+        print("'{}' was already done.".format(language))
+        return
+
+    print("Operations for language '{}'".format(language))
+    start = perf_counter()
+    metrics = instrumentation.disabled
+    if metrics_options is not None:
+        metrics = instrumentation.Metrics(**metrics_options)
+
+    wiki_api = api.API(TF2WIKI_API_LOCATION, session=session, metrics=metrics)
+    wikipedia_api = api.API(
+        WIKIPEDIA_API_LOCATION, session=session, language="en",
+        metrics=metrics
+    )
+    with metrics.phase("pagelist"):
+        pagetitles = None
+        if progress is not None:
+            pagetitles = progress.load(language, "pagelist")
+        if pagetitles is None and title_pool is not None:
+            pagetitles = title_pool.pagelist(language, wiki_api)
+        elif pagetitles is None:
+            pagetitles = wiki_api.retrieve_pagelist(language)
+            if progress is not None:
+                progress.save(language, "pagelist", pagetitles)
+    fields = review.needed_fields(rules)
+
+    # Cached reviews always cover all rules
+    if rules is not None:
+        page_cache = None
+
+    # Reviews of the pages which don't have to be retrieved again, by where
+    # the pages are stored. The pages are only loaded chunk by chunk.
+    stored = OrderedDict()
+    if page_cache is not None:
+        with metrics.phase("revisions"):
+            revisions = wiki_api.retrieve_revisions(
+                pagetitles, chunk_size=CHUNK_SIZE, delay=DELAY
+            )
+            stored[page_cache] = page_cache.load(language, revisions)
+        pagetitles = [
+            title for title in revisions if title not in stored[page_cache]
+        ]
+
+    if progress is not None:
+        checkpointed = progress.load_reviews(language)
+        for reviews in stored.values():
+            for title in checkpointed:
+                reviews.pop(title, None)
+        stored[progress] = checkpointed
+        pagetitles = [
+            title for title in pagetitles if title not in checkpointed
+        ]
+    cached = {
+        title: cached_review
+        for reviews in stored.values()
+        for title, cached_review in reviews.items()
+    }
+
+    data, links = page_query(rules, server_links)
+    packed = []
+    if title_pool is not None:
+        packed, pagetitles = title_pool.take(language, pagetitles)
+        tail = len(pagetitles) % (CHUNK_SIZE or wiki_api.title_limit())
+        if tail:
+            with metrics.phase("retrieve"):
+                packed.extend(title_pool.fill(
+                    pagetitles[-tail:], wiki_api, data, chunk_size=CHUNK_SIZE,
+                    delay=DELAY, links=links
+                ))
+            pagetitles = pagetitles[:-tail]
+
+    if stream:
+        chunks = batched(wiki_api.stream_pages(
+            pagetitles, data, chunk_size=CHUNK_SIZE, delay=DELAY, links=links,
+        ), batch_size)
+    else:
+        responses = wiki_api.retrieve_pages(
+            pagetitles, data, chunk_size=CHUNK_SIZE, delay=DELAY, links=links,
+        )
+        chunks = (
+            list(response["query"]["pages"].values())
+            for response in responses
+        )
+    chunks = metrics.iterate("retrieve", chunks)
+    if window is not None:
+        chunks = prefetch(chunks, window)
+    if packed:
+        chunks = chain(chunks, chunker(packed, BATCH_SIZE))
+    for store, reviews in stored.items():
+        chunks = chain(chunks, map(
+            partial(store.load_pages, language),
+            chunker(list(reviews), BATCH_SIZE)
+        ))
+
+    # Pages with an up-to-date cached review don't have to be reviewed again
+    skip = {
+        title for title, cached_review in cached.items()
+        if cached_review is not None
+    }
+
+    pages = OrderedDict()
+    writer = results.ResultsWriter(language)
+
+    def finish(chunk, chunk_pages, chunk_reviews, metrics_data=None):
+        if metrics_data is not None:
+            metrics.merge(metrics_data)
+        for page in chunk:
+            title = page["title"]
+            # Titles of the pagelist leading to the same page (e.g. through
+            # a redirect) retrieve it again, possibly in another chunk
+            if title in pages:
+                continue
+            if cached.get(title) is not None:
+                writer.add({title: cached[title]})
+                continue
+            page_review = chunk_reviews.get(title, [])
+            writer.add({title: page_review})
+            if page_cache is not None:
+                page_cache.store(
+                    language, page, page_review,
+                    review.page_links(chunk_pages.get(title))
+                )
+            if progress is not None:
+                progress.store_page(language, page, page_review)
+        if page_cache is not None:
+            page_cache.commit()
+        if progress is not None:
+            progress.commit()
+        pages.update(chunk_pages)
+
+    # Batches are handed to the process pool as they come in, but their
+    # results are collected in order to keep the output deterministic
+    pending = deque()
+    max_pending = 2 * (os.cpu_count() or 1)
+    for chunk in chunks:
+        if executor is None:
+            finish(chunk, *parse_and_review(
+                chunk, language, skip, window is not None or stream, rules,
+                metrics
+            ))
+            continue
+
+        for batch in chunker(chunk, batch_size):
+            batch_skip = skip & {page["title"] for page in batch}
+            pending.append((batch, executor.submit(
+                review_batch, batch, language, batch_skip, rules,
+                metrics.enabled
+            )))
+        while len(pending) > max_pending:
+            batch, future = pending.popleft()
+            finish(batch, *future.result())
+
+    while pending:
+        batch, future = pending.popleft()
+        finish(batch, *future.result())
+
+    link_maps = fields & set(review.LINK_MAPS)
+
+    def complete():
+        arguments = None
+        if link_maps:
+            if progress is not None:
+                arguments = progress.load(language, "links")
+            if arguments is None:
+                arguments = review.resolve_arguments(
+                    pages, language, wiki_api, wikipedia_api, link_cache,
+                    metrics, link_maps, langlinks
+                )
+                if progress is not None:
+                    progress.save(language, "links", arguments)
+        stacked_review_pages = review.stacked_review(
+            pages, language, arguments, rules, metrics
+        )
+        with metrics.phase("save"):
+            writer.add(stacked_review_pages)
+            for path in writer.close():
+                print("Saved", path)
+        if progress is not None:
+            progress.save(language, "done", True)
+
+        metrics.export(
+            "metrics{}.json".format(language.upper()), language=language,
+            seconds=perf_counter() - start, pages=len(pages)
+        )
+        print("'{}' done.".format(language))
+
+    if langlinks is not None:
+        if link_maps - {"wikilinks_normal"}:
+            langlinks.add(pages)
+        # Only the links are kept until all other languages are done
+        with metrics.phase("release"):
+            for page in pages.values():
+                review.release_content(page, "links" in fields)
+        return complete
+    complete()
+
+
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Operation Cleanup")
+    parser.add_argument(
+        "--cache", metavar="PATH",
+        help="cache pages in this file and only re-review changed ones"
+    )
+    parser.add_argument(
+        "--workers", metavar="N", type=int, default=1,
+        help="number of languages processed at the same time"
+    )
+    parser.add_argument(
+        "--window", metavar="N", type=int,
+        help="stream pages, retrieving at most N chunks in advance"
+    )
+    parser.add_argument(
+        "--processes", metavar="N", type=int,
+        help="parse and review pages in N worker processes"
+    )
+    parser.add_argument(
+        "--batch-size", metavar="N", type=int, default=BATCH_SIZE,
+        help="number of pages handed to a worker process (or, with "
+             "--stream, reviewed) at once"
+    )
+    parser.add_argument(
+        "--rules", metavar="NAME", nargs="+",
+        help="only run these reviews, e.g. 'wrong_category'"
+    )
+    parser.add_argument(
+        "--link-cache", metavar="PATH", default=":memory:",
+        help="keep resolved links in this file between runs"
+    )
+    parser.add_argument(
+        "--record", metavar="PATH",
+        help="record all API traffic to this archive"
+    )
+    parser.add_argument(
+        "--replay", metavar="PATH",
+        help="replay API traffic from this archive instead of the network"
+    )
+    parser.add_argument(
+        "--metrics", action="store_true",
+        help="export timings and counters to metrics{LANG}.json"
+    )
+    parser.add_argument(
+        "--profile", metavar="DIR",
+        help="profile each phase with cProfile, saving the stats to DIR"
+    )
+    parser.add_argument(
+        "--trace-memory", action="store_true",
+        help="record each phase's peak memory with tracemalloc"
+    )
+    parser.add_argument(
+        "--checkpoint", metavar="PATH",
+        help="record the progress of the run in this file"
+    )
+    parser.add_argument(
+        "--resume", action="store_true",
+        help="continue the run recorded with --checkpoint"
+    )
+    parser.add_argument(
+        "--server-links", action="store_true",
+        help="retrieve the links of pages from the API instead of parsing "
+             "them, if no other review needs the content"
+    )
+    parser.add_argument(
+        "--stream", action="store_true",
+        help="decode responses while reading them and review their pages "
+             "in batches of --batch-size as they come in"
+    )
+    parser.add_argument(
+        "--pack-titles", action="store_true",
+        help="retrieve all pagelists at once and fill up each language's "
+             "last request with titles of the next languages"
+    )
+    parser.add_argument(
+        "--langlinks", action="store_true",
+        help="resolve the Wikipedia links of all languages at once, along "
+             "with the titles of their targets in the other languages"
+    )
+    args = parser.parse_args()
+    if args.resume and args.checkpoint is None:
+        parser.error("--resume requires --checkpoint")
+    if args.workers > 1 and (args.profile or args.trace_memory):
+        parser.error("--profile and --trace-memory require --workers 1")
+    try:
+        review.plan(args.rules)
+    except ValueError as error:
+        parser.error(str(error))
+
     # Note that you're currently just saving the output as files
     test_session = requests.Session()
     test_session.headers["User-Agent"] = "Operation Cleanup (TidB)"
-    main(test_session)
+    main(
+        test_session,
+        cache_path=args.cache, workers=args.workers, window=args.window,
+        processes=args.processes, batch_size=args.batch_size,
+        rules=args.rules, link_cache_path=args.link_cache,
+        record_path=args.record, replay_path=args.replay,
+        metrics=args.metrics, profile_dir=args.profile,
+        trace_memory=args.trace_memory, server_links=args.server_links,
+        checkpoint_path=args.checkpoint, resume=args.resume,
+        stream=args.stream, pack_titles=args.pack_titles,
+        langlinks=args.langlinks
+    )
@@ -0,0 +1,45 @@
+import re
+
+NAMESPACES = ["category", "file", "image", "media"]
+
+
+class Patterns:
+    """Matchers used by the reviews of a single language, compiled once
+    instead of for every page or link.
+
+    Args:
+      language (str): Language of the reviewed pages
+      category_exceptions (list): Patterns of categories which don't have to
+        be localized
+      external_link_exceptions (list): Patterns of external links which
+        don't need a {{Lang icon}}
+    """
+    def __init__(self, language, category_exceptions,
+                 external_link_exceptions):
+        self.language = language
+        self.suffix = "/{}".format(language)
+        self.category_exception = re.compile("|".join(category_exceptions))
+        self.external_link_exception = re.compile(
+            "|".join(external_link_exceptions)
+        )
+        self.community_link = re.compile(
+            r"https?://(www)?\.?steamcommunity\.com/sharedfiles/filedetails/"
+        )
+        self.prefixes = frozenset(NAMESPACES)
+
+    def set_interwiki_prefixes(self, prefixes):
+        """Sets the interwiki prefixes which, like namespaces, mark links as
+        not leading to an article."""
+        self.prefixes = frozenset(NAMESPACES) | frozenset(
+            prefix.lower() for prefix in prefixes
+        )
+
+    def has_prefix(self, link):
+        """Whether a link starts with a namespace or interwiki prefix, e.g.
+        '[[:Category:Foo]]' or '[[w:Foo]]'. A set lookup of the link's prefix
+        instead of matching an alternation of all prefixes."""
+        if link.startswith(":"):
+            link = link[1:]
+        if ":" not in link:
+            return False
+        return link.split(":", 1)[0].lower() in self.prefixes
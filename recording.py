@@ -0,0 +1,126 @@
+"""Recording and replaying of API traffic.
+
+A RecordingSession wraps a requests session and writes every request and
+response to a gzipped JSON lines archive. A ReplaySession serves the
+responses of such an archive back without any network access, so that a
+production run can be profiled over and over at full speed.
+
+Requests are matched by their parameters, so a run can only be replayed if
+it sends the same requests as the recorded one. That isn't the case for runs
+with several workers (main.main's 'workers'): which language queries a link
+first, and which finds it in the shared link cache, depends on the timing of
+their threads.
+"""
+from collections import deque
+import gzip
+import json
+from threading import Lock
+
+
+def request_key(method, url, payload):
+    """Identifies a request independently of the order of its parameters."""
+    return json.dumps(
+        [method, url, sorted((payload or {}).items())], ensure_ascii=False
+    )
+
+
+class RecordingSession:
+    """Wraps 'session' and appends all its requests and responses to the
+    archive at 'path'."""
+    offline = False
+
+    def __init__(self, session, path):
+        self.session = session
+        self.lock = Lock()
+        self.file = gzip.open(path, "wt", encoding="utf-8")
+
+    def __getattr__(self, name):
+        return getattr(self.session, name)
+
+    def record(self, method, url, payload, response):
+        line = json.dumps({
+            "key": request_key(method, url, payload),
+            "status": response.status_code,
+            "headers": {
+                "Retry-After": value
+                for name, value in response.headers.items()
+                if name.lower() == "retry-after"
+            },
+            "body": response.text,
+        }, ensure_ascii=False)
+        with self.lock:
+            self.file.write(line + "\n")
+        return response
+
+    def get(self, url, params=None, **kwargs):
+        response = self.session.get(url, params=params, **kwargs)
+        return self.record("GET", url, params, response)
+
+    def post(self, url, data=None, **kwargs):
+        response = self.session.post(url, data=data, **kwargs)
+        return self.record("POST", url, data, response)
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+class ReplayedResponse:
+    def __init__(self, status_code, headers, text):
+        self.status_code = status_code
+        self.headers = headers
+        self.text = text
+
+    @property
+    def content(self):
+        return self.text.encode("utf-8")
+
+    def json(self):
+        return json.loads(self.text)
+
+    def iter_content(self, chunk_size=1):
+        content = self.content
+        return (
+            content[pos:pos + chunk_size]
+            for pos in range(0, len(content), chunk_size)
+        )
+
+
+class ReplaySession:
+    """Answers requests from the archive at 'path'. Identical requests get
+    their recorded responses in order; once those are used up, the last one
+    is repeated. API instances don't rate limit requests of an offline
+    session."""
+    offline = True
+
+    def __init__(self, path):
+        self.headers = {}
+        self.lock = Lock()
+        self.responses = {}
+        with gzip.open(path, "rt", encoding="utf-8") as file:
+            for line in file:
+                entry = json.loads(line)
+                self.responses.setdefault(entry["key"], deque()).append(
+                    ReplayedResponse(
+                        entry["status"], entry["headers"], entry["body"]
+                    )
+                )
+
+    def replay(self, method, url, payload):
+        key = request_key(method, url, payload)
+        with self.lock:
+            if key not in self.responses:
+                raise KeyError("Request wasn't recorded: {}".format(key))
+            responses = self.responses[key]
+            if len(responses) > 1:
+                return responses.popleft()
+            return responses[0]
+
+    def get(self, url, params=None, **kwargs):
+        return self.replay("GET", url, params)
+
+    def post(self, url, data=None, **kwargs):
+        return self.replay("POST", url, data)
+
+    def close(self):
+        pass
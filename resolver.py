@@ -0,0 +1,37 @@
+class AliasResolver:
+    """Collects the 'normalized' and 'redirects' blocks of query responses and
+    resolves every link to the title it finally ends up at (see
+    review.resolve_links).
+
+    Since all mappings are kept until the end, chains like
+    normalized -> redirect -> target are resolved even if their parts were
+    returned in different chunks.
+    """
+    def __init__(self):
+        self.targets = {}
+        self.resolved = {}
+
+    def add(self, items):
+        """Adds the mappings of a single 'query' block."""
+        for key in ("normalized", "redirects"):
+            for entry in items.get(key, []):
+                self.targets.setdefault(entry["from"], entry["to"])
+        self.resolved.clear()
+
+    def resolve(self, title):
+        """Follows the mappings of 'title' to its final title."""
+        if title in self.resolved:
+            return self.resolved[title]
+
+        chain = []
+        current = title
+        while current in self.targets and current not in chain:
+            chain.append(current)
+            current = self.targets[current]
+            if current in self.resolved:
+                current = self.resolved[current]
+                break
+
+        for alias in chain:
+            self.resolved[alias] = current
+        return current
@@ -0,0 +1,120 @@
+"""Writing of the review results.
+
+For each language, the findings are saved as the wikitext report
+'results{LANG}.txt' and as 'results{LANG}.jsonl', which holds one finding
+per line:
+
+    {"title": ..., "rule": ..., "level": ..., "details": ...}
+
+A file is only replaced if its content changed, so tools watching them (or
+their modification times) only see actual changes.
+"""
+import hashlib
+import json
+import os
+from string import ascii_uppercase
+
+HEADER = "{{Languages}}\n{{Compact ToC|symnum=yes}}\n__NOTOC__\n== !-9 ==\n"
+LEVELS = {
+    "error": "{{c|x|Error}} ",
+    "warning": "{{c|!|Warning}} ",
+}
+BUFFER_SIZE = 2**16
+
+
+def file_hash(path):
+    """Returns the SHA-256 digest of a file's content, or None if it doesn't
+    exist."""
+    digest = hashlib.sha256()
+    try:
+        with open(path, "rb") as file:
+            for block in iter(lambda: file.read(BUFFER_SIZE), b""):
+                digest.update(block)
+    except FileNotFoundError:
+        return None
+    return digest.digest()
+
+
+def write_if_changed(path, parts):
+    """Writes the strings 'parts' to 'path' through a buffer, unless the file
+    already has exactly that content. The file is replaced atomically.
+
+    Returns:
+      Whether the file was (re)written
+    """
+    digest = hashlib.sha256()
+    temporary = path + ".tmp"
+    with open(temporary, "wb", buffering=BUFFER_SIZE) as file:
+        for part in parts:
+            data = part.encode("utf-8")
+            digest.update(data)
+            file.write(data)
+
+    if digest.digest() == file_hash(path):
+        os.remove(temporary)
+        return False
+    os.replace(temporary, path)
+    return True
+
+
+class ResultsWriter:
+    """Collects the findings of a language's reviews as they're completed
+    and writes them, sorted by page title, once all are in.
+
+    Findings are lists of the form [rule, level, details] (see
+    review.simple_review), grouped by page title.
+
+    Args:
+      language (str): Language of the reviewed pages
+      directory (str): Where to save the results
+    """
+    def __init__(self, language, directory="."):
+        self.findings = {}
+        name = os.path.join(directory, "results{}".format(language.upper()))
+        self.report_path = name + ".txt"
+        self.findings_path = name + ".jsonl"
+
+    def add(self, reviewed_pages):
+        """Adds findings of the form {title: [finding, finding, ...]}."""
+        for title, findings in reviewed_pages.items():
+            if findings:
+                self.findings.setdefault(title, []).extend(findings)
+
+    def report(self):
+        """Yields the wikitext report in parts."""
+        yield HEADER
+        current_char = None
+        for title in sorted(self.findings):
+            if title[0] in ascii_uppercase and title[0] != current_char:
+                current_char = title[0]
+                yield "\n== {} ==\n".format(current_char)
+
+            yield "=== [[{}]] ===\n".format(title)
+            for _, level, details in self.findings[title]:
+                yield "* {}{}\n".format(LEVELS.get(level, ""), details)
+            yield "\n"
+
+    def records(self):
+        """Yields the findings as JSON lines."""
+        for title in sorted(self.findings):
+            for rule, level, details in self.findings[title]:
+                yield json.dumps({
+                    "title": title,
+                    "rule": rule,
+                    "level": level,
+                    "details": details,
+                }, ensure_ascii=False) + "\n"
+
+    def close(self):
+        """Writes the report and the findings, skipping unchanged files.
+
+        Returns:
+          List of the paths which were (re)written
+        """
+        return [
+            path for path, parts in (
+                (self.report_path, self.report()),
+                (self.findings_path, self.records()),
+            )
+            if write_if_changed(path, parts)
+        ]
@@ -1,12 +1,21 @@
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
 import re
-from string import ascii_uppercase
 import sys
+from threading import Lock
+from time import perf_counter
 import traceback
 
-from helpers import show_progress
+import features
+from features import templates, wikilinks
+from api import API
+from helpers import Batcher, show_progress
+import instrumentation
+from patterns import Patterns
+from resolver import AliasResolver
 
-CHUNK_SIZE = 50
+CHUNK_SIZE = None  # Titles per request; None uses the API's limit
 DELAY = 0.5
 
 CATEGORY_EXCEPTIONS = [
@@ -43,6 +52,34 @@ DISPLAYTITLE_REQUIRED = [
     "Major updates",
 ]
 
+WIKIPEDIA_PREFIX = re.compile("^(w|wikipedia):", flags=re.I)
+
+patterns = {}
+patterns_lock = Lock()
+
+
+def get_patterns(language):
+    """Returns the compiled patterns.Patterns of a language."""
+    with patterns_lock:
+        if language not in patterns:
+            patterns[language] = Patterns(
+                language, CATEGORY_EXCEPTIONS, EXTERNAL_LINK_EXCEPTIONS
+            )
+        return patterns[language]
+
+
+def fingerprint():
+    """Returns a hash of the rules' source code (including the features and
+    patterns they use), which changes whenever the rules do."""
+    digest = hashlib.sha1()
+    rule_modules = (
+        features, sys.modules[Patterns.__module__], sys.modules[__name__]
+    )
+    for module in rule_modules:
+        with open(module.__file__, "rb") as file:
+            digest.update(file.read())
+    return digest.hexdigest()
+
 
 def merge_dicts(all_reviews1, all_reviews2):
     reviews = all_reviews1.copy()
@@ -55,54 +92,171 @@ def merge_dicts(all_reviews1, all_reviews2):
     return OrderedDict(sorted(reviews.items()))
 
 
-# -------------
-# Simple Review
-# -------------
-simple_reviews = []
+# -----
+# Rules
+# -----
+# Each review is registered with its level and what it needs:
+#
+#   "categories", "displaytitle"  the page's metadata
+#   "content"                     the parsed page
+#   "links"                       the page's links (see collect_links)
+#   one of LINK_MAPS              a map of resolved links, which makes it a
+#                                 stacked review getting that map
+#
+# and optionally a category (formatted with the language) pages have to be
+# in for the review to apply. Whatever no selected review needs isn't
+# retrieved, parsed or resolved (see plan).
+LINK_MAPS = [
+    "wikilinks_normal",
+    "wikipedia_english",
+    "wikipedia_missing",
+    "wikipedia_localized",
+]
+rules = []
 
 
-def save_file(reviewed_pages, language):
-    with open("results{}.txt".format(language.upper()), "wb") as file:
-        file.write(bytes(
-            "{{Languages}}\n{{Compact ToC|symnum=yes}}\n__NOTOC__\n== !-9 ==\n",
-            "utf-8"
+def register(review, level, needs, category=None):
+    """Registers a review.
+
+    Args:
+      review (function): Called with the page, the language and, for stacked
+        reviews, the link map it needs. Returns a message or None.
+      level (str): "error" or "warning"
+      needs (list): What the review needs (see above)
+      category (str): Category pages have to be in, e.g.
+        "Category:Cosmetic items/{}"
+    """
+    needs = set(needs)
+    link_maps = needs & set(LINK_MAPS)
+    if len(link_maps) > 1:
+        raise ValueError("{} needs more than one link map".format(
+            review.__name__
         ))
-        current_char = "Whatever this doesn't even matter"
-        for title, value in reviewed_pages.items():
-            if title[0] in ascii_uppercase and title[0] != current_char:
-                current_char = title[0]
-                file.write(bytes(
-                    "\n== {} ==\n".format(current_char),
-                    "utf-8"
-                ))
-
-            file.write(bytes(
-                "=== [[{}]] ===\n".format(title) +
-                "".join(value) +
-                "\n",
-                "utf-8"
+    if link_maps:
+        needs.add("links")
+    if category is not None:
+        needs.add("categories")
+    rules.append({
+        "review": review,
+        "name": review.__name__,
+        "level": level,
+        "needs": frozenset(needs),
+        "category": category,
+        "argument": link_maps.pop() if link_maps else None,
+    })
+
+
+def plan(names=None):
+    """Selects the reviews in 'names' (all if None) and collects everything
+    they need.
+
+    Returns:
+      Dictionary of the form
+
+      {
+          "simple": [rule, ...],
+          "stacked": [rule, ...],
+          "needs": {"content", "wikipedia_english", ...},
+      }
+
+    Raises:
+      ValueError: If one of the names isn't a registered review
+    """
+    if names is not None:
+        unknown = set(names) - {rule["name"] for rule in rules}
+        if unknown:
+            raise ValueError("Unknown reviews: {}".format(
+                ", ".join(sorted(unknown))
             ))
+    selected = [
+        rule for rule in rules if names is None or rule["name"] in names
+    ]
+    needs = set()
+    for rule in selected:
+        needs.update(rule["needs"])
+    return {
+        "simple": [rule for rule in selected if rule["argument"] is None],
+        "stacked": [rule for rule in selected if rule["argument"] is not None],
+        "needs": needs,
+    }
+
+
+def needed_fields(names=None):
+    """Returns what the given reviews (all if 'names' is None) need: the
+    page fields "content", "categories", "displaytitle" and "links", and the
+    link maps of LINK_MAPS. "links" can be collected from the content or
+    retrieved instead of it (see API.retrieve_pages)."""
+    return plan(names)["needs"]
+
+
+def applies(rule, page, language):
+    """Whether a review applies to a page, given its category."""
+    return rule["category"] is None or \
+        rule["category"].format(language) in page["categories"]
+
+
+def needs_content(page, language, names=None):
+    """Whether the given reviews (all if 'names' is None) will parse the
+    content of 'page'."""
+    if page.get("text") is None:
+        return False
+    selected = plan(names)
+    if "links" in selected["needs"] and "wikilinks" not in page:
+        return True
+    return any(
+        "content" in rule["needs"] and applies(rule, page, language)
+        for rule in selected["simple"]
+    )
+
+
+def review_page(page, language, selected, metrics, arguments=None):
+    """Runs the reviews 'selected' (see plan) which apply to a page and
+    returns its findings in the form [[rule, level, details], ...]."""
+    reviews = []
+    for rule in selected:
+        if not applies(rule, page, language):
+            continue
+        args = [page, language]
+        if rule["argument"] is not None:
+            args.append(arguments[rule["argument"]])
+        start = perf_counter()
+        try:
+            result = rule["review"](*args)
+        except Exception:
+            print("Error reviewing", page["title"], file=sys.stderr)
+            print(traceback.format_exc(), file=sys.stderr)
+            metrics.count("review errors")
+            continue
+        finally:
+            metrics.rule(rule["name"], perf_counter() - start)
+        if result is not None:
+            reviews.append([rule["name"], rule["level"], result])
+    return reviews
+
+
+# -------------
+# Simple Review
+# -------------
+def simple_review(pages, language, names=None, metrics=None):
+    """Runs the simple reviews (or only those in 'names') on all pages. The
+    time spent in each review is recorded in 'metrics', if given.
+
+    Returns an OrderedDict of the form
 
+    {
+        "title": [[rule, level, details], ...],
+    }
 
-def simple_review(pages, language):
+    for all pages with findings (see results.ResultsWriter).
+    """
+    metrics = metrics or instrumentation.disabled
+    selected = plan(names)["simple"]
     reviewed_pages = OrderedDict()
+    if not selected:
+        return reviewed_pages
     for i, (title, page) in enumerate(pages.items()):
         show_progress(i+1, len(pages), "Reviewing "+title)
-        reviews = []
-        for review, level in simple_reviews:
-            try:
-                result = review(page, language)
-            except Exception:
-                print("Error reviewing", title, file=sys.stderr)
-                print(traceback.format_exc(), file=sys.stderr)
-                continue
-            if result is not None:
-                reviews.append("* ")
-                if level == "error":
-                    reviews.append("{{c|x|Error}} ")
-                elif level == "warning":
-                    reviews.append("{{c|!|Warning}} ")
-                reviews.append(result+"\n")
+        reviews = review_page(page, language, selected, metrics)
         if reviews:
             reviewed_pages[title] = reviews
     show_progress(len(pages), len(pages), "Reviewed all.", True)
@@ -112,7 +266,7 @@ def simple_review(pages, language):
 def displaytitle(page, language):
     if page["displaytitle"].endswith("/{}".format(language)):
             return "Not displaying the correct title; {{tl|DISPLAYTITLE}} might be needed."
-    elif page["content"].filter_templates(matches="DISPLAYTITLE:"):
+    elif templates(page, "DISPLAYTITLE:"):
         if [
             c for c in DISPLAYTITLE_REQUIRED
             if "Category:{}/{}".format(c, language) in page["categories"]
@@ -122,455 +276,703 @@ def displaytitle(page, language):
             if "Category:{}/{}".format(category, language) in page["categories"] and \
                     page["title"] != "{}/{}".format(category, language):
                 return "Usage of {{tl|DISPLAYTITLE}} on inappropriate page."
-simple_reviews.append([displaytitle, "error"])
+register(displaytitle, "error", ["displaytitle", "categories", "content"])
 
 
 def name_parameter(page, language):
-    if page["content"].filter_templates(
-        matches=lambda x: x.name.matches("Item infobox") and x.has("name")
-    ):
-        if "Category:Cosmetic items/{}".format(language) in page["categories"]:
-            return "Usage of the {{code|name}} parameter in the item infobox on an item page."
-simple_reviews.append([name_parameter, "error"])
+    if [
+        template for template in templates(page, "Item infobox")
+        if template.has("name")
+    ]:
+        return "Usage of the {{code|name}} parameter in the item infobox on an item page."
+register(name_parameter, "error", ["content"],
+         category="Category:Cosmetic items/{}")
 
 
 def wikipedia_template(page, language):
-    templates = page["content"].filter_templates(
-        matches=lambda x: x.name.matches("w")
-    )
-    if templates:
+    w_templates = templates(page, "w")
+    if w_templates:
         return "{} use(s) of {{{{tl|w}}}}; should be replaced with {{{{code|<nowiki>[[w:{}:Link|Caption]]</nowiki>}}}}.".format(
-            len(templates),
+            len(w_templates),
             language
         )
-simple_reviews.append([wikipedia_template, "error"])
+register(wikipedia_template, "error", ["content"])
 
 
 def if_lang(page, language):
-    templates = page["content"].filter_templates(
-        matches=lambda x: x.name.matches("if lang")
-    )
-    if templates:
+    if_lang_templates = templates(page, "if lang")
+    if if_lang_templates:
         return "{} use(s) of {{{{tl|if lang}}}}; should be replaced with {{{{code|/{}}}}}.".format(
-            len(templates),
+            len(if_lang_templates),
             language
         )
-simple_reviews.append([if_lang, "error"])
+register(if_lang, "error", ["content"])
 
 
 def no_label(page, language):
-    links = page["content"].filter_wikilinks(
-        matches=lambda x: not x.title.lower().startswith("category:")
-    )
     bad_links = [
         "{{{{code|<nowiki>{}</nowiki>}}}}".format(link)
-        for link in links
-        if not link.text and link.title.endswith("/{}".format(language))
+        for link in page["features"]["wikilink_list"]
+        if not str(link.title).lower().startswith("category:") and
+        not link.text and link.title.endswith("/{}".format(language))
     ]
     if bad_links:
         return "No label on localized link(s) {}".format(
             ", ".join(bad_links)
         )
-simple_reviews.append([no_label, "error"])
+register(no_label, "error", ["content"])
 
 
 def wrong_category(page, language):
+    language_patterns = get_patterns(language)
     bad_categories = [
         "{{{{code|<nowiki>{}</nowiki>}}}}".format(category)
         for category in page["categories"]
-        if (not re.match("|".join(CATEGORY_EXCEPTIONS), category)) and
-        not category.endswith("/{}".format(language))
+        if not language_patterns.category_exception.match(category) and
+        not category.endswith(language_patterns.suffix)
     ]
     if bad_categories:
         return "Wrong category/categories {}".format(
             ", ".join(bad_categories)
         )
-simple_reviews.append([wrong_category, "warning"])
+register(wrong_category, "warning", ["categories"])
 
 
 def localized_template(page, language):
-    templates = page["content"].ifilter_templates()
     bad_templates = [
         "{{{{code|<nowiki>{}</nowiki>}}}}".format(template.name)
-        for template in templates
+        for template in page["features"]["template_list"]
         if template.name.endswith("/{}".format(language))
     ]
     if bad_templates:
         return "Wrong template(s); translated strings in this template(s) may be moved to the correct one(s): {}".format(
             ", ".join(bad_templates)
         )
-simple_reviews.append([localized_template, "error"])
+register(localized_template, "error", ["content"])
 
 
 def no_loadout_name(page, _):
-    infobox = page["content"].filter_templates(matches="Item infobox")
+    infobox = templates(page, "Item infobox")
     if infobox and not infobox[0].has("loadout-name"):
         return "No usage of the {{code|loadout-name}} parameter in the item infobox"
-simple_reviews.append([no_loadout_name, "warning"])
+register(no_loadout_name, "warning", ["content"])
 
 
 def external_links(page, language):
-    # Filter "this item was [http://steamcommunity.com contributed] to..."
-    externallinks = [
-        link
-        for link in page["content"].filter_external_links()
-        if not (
-            "Category:Community-contributed items/{}".format(language) in page["categories"] and
-            re.match("https?://(www)?\.?steamcommunity\.com/sharedfiles/filedetails/", link.url.strip_code())
-        )
-    ]
+    language_patterns = get_patterns(language)
+    community_contributed = \
+        "Category:Community-contributed items/{}".format(language) in page["categories"]
 
-    patch_layout = page["content"].filter_templates(matches="Patch layout")
+    # Filter special patch links with automatic {{Lang icon}}
+    patch_links = set()
+    patch_layout = templates(page, "Patch layout")
     if patch_layout:
         patch_layout = patch_layout[0]
-        for link in externallinks:
-            if (
-                    # Filter special patch links with automatic {{Lang icon}}
-                    (
-                        patch_layout.has("source") and
-                        patch_layout.get("source").value.strip() and
-                        link is patch_layout.get("source").value.filter_external_links()[0]
-                    ) or
-                    (
-                        patch_layout.has("updatelink") and
-                        link is patch_layout.get("updatelink").value.filter_external_links()[0]
-                    )
-            ):
-                externallinks.remove(link)
+        if patch_layout.has("source") and \
+                patch_layout.get("source").value.strip():
+            patch_links.update(
+                id(link) for link in
+                patch_layout.get("source").value.filter_external_links()[:1]
+            )
+        if patch_layout.has("updatelink"):
+            patch_links.update(
+                id(link) for link in
+                patch_layout.get("updatelink").value.filter_external_links()[:1]
+            )
 
-    # Filter other exceptions
-    for link in externallinks:
-        if re.match("|".join(EXTERNAL_LINK_EXCEPTIONS), link.url.strip_code()):
-            externallinks.remove(link)
+    externallinks = [
+        link
+        for link, url in page["features"]["external_links"]
+        # Filter "this item was [http://steamcommunity.com contributed] to..."
+        if not (community_contributed and
+                language_patterns.community_link.match(url)) and
+        id(link) not in patch_links and
+        # Filter other exceptions
+        not language_patterns.external_link_exception.match(url)
+    ]
 
-    templates = page["content"].filter_templates(matches="Lang icon")
-    difference = len(externallinks) - len(templates)
+    lang_icons = templates(page, "Lang icon")
+    difference = len(externallinks) - len(lang_icons)
     if difference > 0:
         return "{} external link(s) without {{{{tlx|lang icon|en}}}}".format(
             difference
         )
-simple_reviews.append([external_links, "warning"])
+register(external_links, "warning", ["categories", "content"])
 
 
 # --------------
 # Stacked Review
 # --------------
-stacked_reviews = []
 
 
-def stacked_review(pages, language, wiki_api, wikipedia_api):
-    """Reviews based on retrieved TF2 Wiki and Wikipedia pages."""
+def resolve_arguments(pages, language, wiki_api, wikipedia_api,
+                      link_cache=None, metrics=None, maps=None,
+                      langlinks=None):
+    """Resolves the links of all pages and returns the link maps of the
+    stacked reviews: {name: {link: title}}. Only the maps in 'maps' (all of
+    LINK_MAPS if None) are built, skipping the requests only other maps
+    need. Links are resolved through 'link_cache' (a cache.LinkCache), if
+    given. The time spent is recorded in 'metrics', if given.
+
+    If 'langlinks' (a Langlinks holding the resolved Wikipedia links of all
+    languages) is given, the English Wikipedia isn't queried again, and
+    "wikipedia_english" maps links to the title of their target on the
+    Wikipedia in 'language', if it has one. Otherwise those titles are
+    None."""
+    metrics = metrics or instrumentation.disabled
+    maps = set(LINK_MAPS if maps is None else maps)
+    arguments = {}
+
+    def resolve_wikilinks():
+        with metrics.phase("resolve links"):
+            prefixes = get_prefixes(wiki_api)
+            _, wikilinks = get_wikilinks(pages, language, prefixes)
+            return normalize_wikilinks(wikilinks, wiki_api, link_cache)
+
+    # The TF2 Wiki and the English and localized Wikipedias are different
+    # hosts with rate limits of their own. The TF2 Wiki's links are resolved
+    # in a thread of their own, and interwiki titles are resolved on the
+    # localized Wikipedia as soon as the English one returns them.
+    #
+    # Each review only has to look up a page's own links instead of scanning
+    # every resolved title and its aliases, hence the indices.
+    with ThreadPoolExecutor(max_workers=1) as executor, \
+            metrics.phase("resolve links"):
+        # Both threads read the links, so they're collected beforehand
+        for page in pages.values():
+            if "wikilinks" not in page:
+                collect_links(page)
+
+        wikilinks_normal = None
+        if "wikilinks_normal" in maps:
+            wikilinks_normal = executor.submit(resolve_wikilinks)
+
+        if maps - {"wikilinks_normal"}:
+            _, wikipedia_links = get_wikipedia_links(pages)
+            localized = on_interwiki = None
+            if langlinks is None and \
+                    maps & {"wikipedia_missing", "wikipedia_localized"}:
+                localized, on_interwiki = resolve_localized(
+                    wikipedia_api, language, link_cache, metrics
+                )
+
+            if langlinks is None:
+                wikipedia_missing, wikipedia_english, wikipedia_interwiki = \
+                    normalize_wikipedia(
+                        wikipedia_links, wikipedia_api, link_cache,
+                        on_interwiki
+                    )
+            else:
+                resolved = langlinks.get(wikipedia_links)
+                wikipedia_missing, wikipedia_english, wikipedia_interwiki = (
+                    group_links(resolved, kind)
+                    for kind in ("missing", "page", "interwiki")
+                )
+            arguments["wikipedia_english"] = {
+                link: None if langlinks is None
+                else langlinks.counterpart(title, language)
+                for link, title in index_aliases(wikipedia_english).items()
+            }
+
+            if maps & {"wikipedia_missing", "wikipedia_localized"}:
+                resolved = {}
+                if localized is not None:
+                    for batch in localized.finish():
+                        resolved.update(batch)
+                wikipedia_localized, wikipedia_missing_language = normalize_wikipedia_localized(
+                    wikipedia_interwiki,
+                    wikipedia_api,
+                    language,
+                    link_cache,
+                    resolved
+                )
+                arguments["wikipedia_missing"] = index_aliases(
+                    merge_dicts(wikipedia_missing, wikipedia_missing_language)
+                )
+                arguments["wikipedia_localized"] = index_aliases(
+                    wikipedia_localized
+                )
+
+        if wikilinks_normal is not None:
+            arguments["wikilinks_normal"] = index_aliases(
+                wikilinks_normal.result()
+            )
+
+    return {name: arguments[name] for name in maps}
+
+
+def resolve_localized(wikipedia_api, language, link_cache=None,
+                      metrics=None):
+    """Starts resolving interwiki titles on the Wikipedia in 'language' in
+    the background, in batches as large as the API allows.
+
+    Returns:
+      Tuple of the helpers.Batcher doing so, whose results are parts of the
+      form of resolve_links, and a function to pass newly found interwiki
+      titles to (see resolve_links)
+    """
+    metrics = metrics or instrumentation.disabled
+    api = localized_wikipedia(wikipedia_api, language)
+    seen = set()
+
+    def resolve(titles):
+        with metrics.phase("resolve links"):
+            return resolve_links(titles, api, link_cache)
+
+    def on_interwiki(titles):
+        titles = [title for title in titles if title not in seen]
+        seen.update(titles)
+        if titles:
+            batcher.add(titles)
+
+    batcher = Batcher(resolve, CHUNK_SIZE or api.title_limit())
+    return batcher, on_interwiki
+
+
+def stacked_review(pages, language, arguments, names=None, metrics=None):
+    """Reviews based on retrieved TF2 Wiki and Wikipedia pages, using the
+    link maps in 'arguments' (see resolve_arguments). If 'names' is given,
+    only the stacked reviews in it are run. The time spent in each review is
+    recorded in 'metrics', if given."""
+    metrics = metrics or instrumentation.disabled
+    selected = plan(names)["stacked"]
     reviewed_pages = OrderedDict()
+    if not selected:
+        return reviewed_pages
+
+    with metrics.phase("stacked review"):
+        for title, page in pages.items():
+            reviews = review_page(page, language, selected, metrics, arguments)
+            if reviews:
+                reviewed_pages[title] = reviews
+    return reviewed_pages
 
-    prefixes = get_prefixes(wiki_api)
-    pages, wikilinks = get_wikilinks(pages, language, prefixes)
-    pages, wikipedia_links = get_wikipedia_links(pages)
-    wikilinks_normal = normalize_wikilinks(wikilinks, wiki_api)
-
-    wikipedia_missing, wikipedia_english, wikipedia_interwiki = \
-        normalize_wikipedia(wikipedia_links, wikipedia_api)
-    wikipedia_localized, wikipedia_missing_language = normalize_wikipedia_localized(
-        wikipedia_interwiki,
-        wikipedia_api,
-        language
-    )
 
-    arguments = {
-        "wikilinks_normal": wikilinks_normal,
-        "wikipedia_missing": merge_dicts(wikipedia_missing, wikipedia_missing_language),
-        "wikipedia_english": wikipedia_english,
-        "wikipedia_localized": wikipedia_localized
+def index_aliases(links):
+    """Inverts a dictionary of the form
+
+    {
+        "title": ["alias", "alias", ...]
     }
 
-    for title, page in pages.items():
-        reviews = []
-        for review, args, level in stacked_reviews:
-            try:
-                result = review(page, language, arguments[args])
-            except Exception:
-                print("Error reviewing", title, file=sys.stderr)
-                print(traceback.format_exc(), file=sys.stderr)
-                continue
-            if result is not None:
-                reviews.append("* ")
-                if level == "error":
-                    reviews.append("{{c|x|Error}} ")
-                elif level == "warning":
-                    reviews.append("{{c|!|Warning}} ")
-                reviews.append(result+"\n")
-        if reviews:
-            reviewed_pages[title] = reviews
-    return reviewed_pages
+    into an index mapping the title and each of its aliases to the title."""
+    index = {}
+    for title, aliases in links.items():
+        index[title] = title
+        for alias in aliases:
+            index.setdefault(alias, title)
+    return index
 
 
 def get_prefixes(wiki_api):
     """Get the used prefixes for interwiki links which have to be ignored.
     Returns a list string, each one being a prefix."""
-    response = wiki_api.session.get(wiki_api.api_location, params={
-        "action": "query",
-        "meta": "siteinfo",
-        "siprop": "interwikimap",
-        "format": "json",
-    }).json()
-
-    prefixes = [item["prefix"] for item in response["query"]["interwikimap"]]
+    siteinfo = wiki_api.siteinfo()
+    prefixes = [item["prefix"] for item in siteinfo["interwikimap"]]
     return prefixes
 
 
+def collect_links(page):
+    """Stores a page's wikilinks (including links inside 'main' and 'see also'
+    templates) and Wikipedia links in its 'wikilinks' and 'wikipedia' fields.
+    Afterwards, the stacked reviews don't need the page's content anymore."""
+    links = set()
+
+    # Collecting ordinary wikilinks
+    for wikilink in page["features"]["wikilink_list"]:
+        links.add(str(wikilink.title))
+
+    # Collecting wikilinks inside "main" and "see also" templates
+    for template in templates(page, "see also") + templates(page, "main"):
+        for link in template.params:
+            if not link.showkey:
+                links.add(str(link.value))
+
+    page["wikilinks"] = links
+
+    wikipedia_links = set()
+    for wikipedia_link in wikilinks(page, "w", "wikipedia"):
+        title = str(wikipedia_link.title)
+        title = WIKIPEDIA_PREFIX.sub("", title)
+        wikipedia_links.add(title)
+
+    page["wikipedia"] = wikipedia_links
+
+
+def page_links(page):
+    """Returns the links of a page (collecting them if necessary) in the
+    form {"wikilinks": [...], "wikipedia": [...]}, e.g. to store them along
+    with it, or None if there's no page or it has no content to collect them
+    from."""
+    if page is None:
+        return None
+    if "wikilinks" not in page:
+        if page.get("text") is None and page.get("content") is None:
+            return None
+        collect_links(page)
+    return {
+        "wikilinks": list(page["wikilinks"]),
+        "wikipedia": list(page["wikipedia"]),
+    }
+
+
+def release_content(page, links=True):
+    """Collects everything the stacked reviews need from a page (unless
+    'links' is False, because none will run or they were collected already)
+    and drops its parsed content to free memory."""
+    if links and "wikilinks" not in page and (
+            page.get("text") is not None or page.get("content") is not None):
+        collect_links(page)
+    page["text"] = None
+    page["content"] = None
+    page["features"] = None
+
+
 def get_wikilinks(pages, language, prefixes):
     """Get wikilinks and links inside 'main' and 'see also' templates."""
     all_links = set()
     for page in pages.values():
-        links = set()
-
-        # Collecting ordinary wikilinks
-        for wikilink in page["content"].filter_wikilinks():
-            links.add(str(wikilink.title))
-
-        # Collecting wikilinks inside "main" and "see also" templates
-        for template in page["content"].filter_templates(
-            matches=lambda x: str(x.name) in ("see also", "main")
-        ):
-            for link in template.params:
-                if not link.showkey:
-                    links.add(str(link.value))
-
-        # Removing duplicates, eliminating all non-wikilinks
-        cleaned_links = {
-            link for link in links
-            if
-            not re.match(                                                       # Must be in main namespace
-                ":?(category|file|image|media|{}):".format("|".join(prefixes)),
-                link, flags=re.I
-            ) and
-            not any(x in link for x in "{}[]<>") and                            # Containing special chars
-            not link.startswith("#") and                                        # In-page links
-            not "/{}".format(language) in link                                  # Localized links
-        }
-
-        all_links = all_links | cleaned_links
-        pages[page["title"]]["wikilinks"] = list(links)
+        if "wikilinks" not in page:
+            collect_links(page)
+        all_links.update(page["wikilinks"])
+
+    language_patterns = get_patterns(language)
+    language_patterns.set_interwiki_prefixes(prefixes)
+
+    # Removing duplicates, eliminating all non-wikilinks
+    cleaned_links = {
+        link for link in all_links
+        if
+        not language_patterns.has_prefix(link) and                          # Must be in main namespace
+        not any(x in link for x in "{}[]<>") and                            # Containing special chars
+        not link.startswith("#") and                                        # In-page links
+        not language_patterns.suffix in link                                # Localized links
+    }
 
-    return pages, list(all_links)
+    return pages, list(cleaned_links)
 
 
 def get_wikipedia_links(pages):
     all_links = set()
     for page in pages.values():
-        links = set()
+        if "wikipedia" not in page:
+            collect_links(page)
+        all_links.update(page["wikipedia"])
 
-        for wikipedia_link in page["content"].filter_wikilinks():
-            title = str(wikipedia_link.title)
-            if re.match("(w|wikipedia):", title, flags=re.I):
-                title = re.sub("^(w|wikipedia):", "", title, flags=re.I)
-                links.add(title)
+    return pages, list(all_links)
 
-        all_links = all_links | links
-        pages[page["title"]]["wikipedia"] = list(links)
 
-    return pages, list(all_links)
+def resolve_links(links, api, link_cache=None, on_interwiki=None):
+    """Resolves links to what they lead to after normalizing them and
+    resolving redirects. Links are normalized locally where possible (see
+    titles.TitleNormalizer), so links differing only in e.g. capitalization
+    of the first letter or underscores are queried once. Only titles which
+    aren't in 'link_cache' yet are queried, and the results are stored in it.
 
+    If given, 'on_interwiki' is called with the interwiki titles found in
+    the cache and in each chunk of responses as soon as they're known.
 
-def normalize_wikilinks(links, wiki_api):
-    """Create a dictionary with the format
+    Returns a dictionary of the form
 
     {
-        "title": ["alias", "alias", ...]
+        "link": (kind, "title"),
     }
-    """
 
-    site = wiki_api.retrieve_pages(
-        links,
-        data={
-            "action": "query",
-            "format": "json",
-            "redirects": "",
-        },
-        chunk_size=CHUNK_SIZE,
-        delay=DELAY,
+    with kind being "page", "missing" or "interwiki".
+    """
+    normalizer = api.title_normalizer()
+    normalized = {
+        link: normalizer.normalize(link) or link for link in links
+    }
+    # Sorted, so that the requests don't depend on the order of a set of
+    # links, which changes with the hash seed (see recording.ReplaySession)
+    titles = sorted(set(normalized.values()))
+
+    resolved = {}
+    if link_cache is not None:
+        resolved = link_cache.get(api.api_location, titles)
+    queried = [title for title in titles if title not in resolved]
+    if on_interwiki is not None:
+        on_interwiki([
+            title for kind, title in resolved.values() if kind == "interwiki"
+        ])
+
+    data = {
+        "action": "query",
+        "format": "json",
+        "redirects": "",
+    }
+    site = api.retrieve_pages(
+        queried, data=data, chunk_size=CHUNK_SIZE, delay=DELAY,
     )
 
-    pages = {}
+    resolver = AliasResolver()
+    kinds = {}
     for items in site:
         items = items["query"]
 
-        # Create entries for each page we're *actually* linking to (after
-        # normalizing links and resolving redirects)
-        for value in items["pages"].values():
-            if value["title"] not in pages and "missing" not in value:
-                pages[value["title"]] = []
-
-        # Add resolved redirects to a page's aliases
-        if "redirects" in items:
-            for redirect in items["redirects"]:
-                for page, aliases in pages.items():
-                    if redirect["to"] == page \
-                            and redirect["from"] not in aliases:
-                        pages[page].append(redirect["from"])
-
-        # Add normalized forms of the link or its aliases
-        if "normalized" in items:
-            for normal in items["normalized"]:
-                for page, aliases in pages.items():
-                    if (normal["to"] == page or normal["to"] in aliases) \
-                            and normal["from"] not in aliases:
-                        pages[page].append(normal["from"])
+        # Pages we're *actually* linking to (after normalizing links and
+        # resolving redirects)
+        for value in items.get("pages", {}).values():
+            if "missing" in value:
+                kinds[value["title"]] = "missing"
+            elif "invalid" not in value:
+                kinds[value["title"]] = "page"
+
+        for page in items.get("interwiki", []):
+            kinds[page["title"]] = "interwiki"
+        if on_interwiki is not None:
+            on_interwiki([page["title"] for page in items.get("interwiki", [])])
+
+        # Collect resolved redirects and normalized forms as aliases
+        resolver.add(items)
+
+    fresh = {}
+    for link in queried:
+        title = resolver.resolve(link)
+        if title in kinds:
+            fresh[link] = (kinds[title], title)
+
+    if link_cache is not None:
+        link_cache.store(api.api_location, fresh)
+    resolved.update(fresh)
+    return {
+        link: resolved[title] for link, title in normalized.items()
+        if title in resolved
+    }
+
 
+def group_links(resolved, kind):
+    """Create a dictionary with the format
+
+    {
+        "title": ["alias", "alias", ...]
+    }
+
+    of all resolved links of the given kind.
+    """
+    pages = {}
+    for link, (link_kind, title) in resolved.items():
+        if link_kind != kind:
+            continue
+        aliases = pages.setdefault(title, [])
+        if link != title:
+            aliases.append(link)
     return pages
 
 
-def normalize_wikipedia(links, wiki_api):
+def normalize_wikilinks(links, wiki_api, link_cache=None):
     """Create a dictionary with the format
 
     {
         "title": ["alias", "alias", ...]
     }
+
+    of all existing pages the links lead to.
     """
+    return group_links(resolve_links(links, wiki_api, link_cache), "page")
 
-    site = wiki_api.retrieve_pages(
-        links,
-        data={
-            "action": "query",
-            "format": "json",
-            "redirects": "",
-        },
-        chunk_size=CHUNK_SIZE,
-        delay=DELAY,
-    )
 
-    missing_pages = {}
-    english_pages = {}
-    interwiki_pages = {}
+def normalize_wikipedia(links, wiki_api, link_cache=None, on_interwiki=None):
+    """Create dictionaries with the format
 
-    for items in site:
-        items = items["query"]
+    {
+        "title": ["alias", "alias", ...]
+    }
 
-        # All pages retrieved in the first run are English or missing
-        if "pages" in items:
-            for value in items["pages"].values():
-                if "missing" in value:
-                    missing_pages[value["title"]] = []
-                else:
-                    english_pages[value["title"]] = []
-
-        # All interwiki links
-        if "interwiki" in items:
-            for page in items["interwiki"]:
-                interwiki_pages[page["title"]] = []
-
-        # Add resolved redirects to a page's aliases
-        if "redirects" in items:
-            for redirect in items["redirects"]:
-                for dictionary in [english_pages, interwiki_pages, missing_pages]:
-                    for page, aliases in dictionary.items():
-                        if redirect["to"] == page \
-                                and redirect["from"] not in aliases:
-                            dictionary[page].append(redirect["from"])
-
-        # Add normalized forms of the link or its aliases
-        if "normalized" in items:
-            for normal in items["normalized"]:
-                for dictionary in [english_pages, interwiki_pages, missing_pages]:
-                    for page, aliases in dictionary.items():
-                        if (normal["to"] == page or normal["to"] in aliases) \
-                                and normal["from"] not in aliases:
-                            dictionary[page].append(normal["from"])
-
-    return missing_pages, english_pages, interwiki_pages
-
-
-def normalize_wikipedia_localized(interwiki_links, wikipedia_api, language):
+    of missing, English and interwiki pages the links lead to. Interwiki
+    titles are passed to 'on_interwiki' as they're found, if given.
+    """
+    resolved = resolve_links(links, wiki_api, link_cache, on_interwiki)
+    return (
+        group_links(resolved, "missing"),
+        group_links(resolved, "page"),
+        group_links(resolved, "interwiki"),
+    )
+
+
+def wikipedia_language(language):
+    """Returns the language code of the Wikipedia for 'language'."""
     if language == "pt-br":
-        language = "pt"
+        return "pt"
     elif language in ["zh-hans", "zh-hant"]:
-        language = "zh"
-    wikipedia_api.language = language
-
-    site = wikipedia_api.retrieve_pages(
-        list(interwiki_links.keys()),
-        data={
-            "action": "query",
-            "format": "json",
-            "redirects": "",
-        },
-        chunk_size=CHUNK_SIZE,
-        delay=DELAY,
+        return "zh"
+    return language
+
+
+def localized_wikipedia(wikipedia_api, language):
+    """Returns an API of the Wikipedia in 'language'."""
+    return API(
+        wikipedia_api.api_location_raw, session=wikipedia_api.session,
+        language=wikipedia_language(language), metrics=wikipedia_api.metrics
     )
 
-    missing_pages = {}
-    language_pages = {}
 
-    for items in site:
-        items = items["query"]
+def retrieve_langlinks(titles, api, link_cache=None, languages=None):
+    """Returns the titles the pages 'titles' have on the wikis in other
+    languages (prop=langlinks) in the form {title: {language: title}}, only
+    keeping 'languages' if given. Only pages which aren't in 'link_cache' yet
+    are queried, and the results are stored in it."""
+    langlinks = {}
+    if link_cache is not None:
+        langlinks = link_cache.get_langlinks(api.api_location, titles)
+    queried = [title for title in titles if title not in langlinks]
+
+    fresh = {}
+    for response in api.retrieve_pages(queried, data={
+        "action": "query",
+        "format": "json",
+        "prop": "langlinks",
+        "lllimit": "max",
+    }, chunk_size=CHUNK_SIZE, delay=DELAY):
+        for page in response["query"].get("pages", {}).values():
+            if "missing" not in page and "invalid" not in page:
+                fresh[page["title"]] = {
+                    link["lang"]: link["*"]
+                    for link in page.get("langlinks", [])
+                }
+
+    if link_cache is not None:
+        link_cache.store_langlinks(api.api_location, fresh)
+    langlinks.update(fresh)
+    return {
+        title: {
+            language: counterpart for language, counterpart in links.items()
+            if languages is None or language in languages
+        }
+        for title, links in langlinks.items()
+    }
+
+
+class Langlinks:
+    """The Wikipedia links of all languages, resolved once on the English
+    Wikipedia along with the titles their targets have on the Wikipedias in
+    the other languages (see retrieve_langlinks), instead of once per
+    language.
+
+    Each language adds its pages; once all are in, resolve queries the union
+    of their links, and resolve_arguments takes each language's links from
+    it. Interwiki titles are still resolved on each localized Wikipedia.
+    Pages may be added by several threads at a time.
+
+    Args:
+      languages (list): Languages of the TF2 Wiki whose Wikipedias' titles
+        are kept; all if None
+    """
+    def __init__(self, languages=None):
+        self.lock = Lock()
+        self.languages = None
+        if languages is not None:
+            self.languages = {
+                wikipedia_language(language) for language in languages
+            }
+        self.links = set()
+        self.resolved = {}
+        self.counterparts = {}
+
+    def add(self, pages):
+        _, links = get_wikipedia_links(pages)
+        with self.lock:
+            self.links.update(links)
+
+    def resolve(self, wikipedia_api, link_cache=None, metrics=None):
+        """Resolves all added links on the English Wikipedia, through
+        'link_cache' if given."""
+        metrics = metrics or instrumentation.disabled
+        with metrics.phase("resolve links"):
+            self.resolved = resolve_links(
+                sorted(self.links), wikipedia_api, link_cache
+            )
+            titles = sorted({
+                title for kind, title in self.resolved.values()
+                if kind == "page"
+            })
+            self.counterparts = retrieve_langlinks(
+                titles, wikipedia_api, link_cache, self.languages
+            )
+
+    def get(self, links):
+        """Returns the resolved 'links' in the form of resolve_links."""
+        return {
+            link: self.resolved[link] for link in links
+            if link in self.resolved
+        }
+
+    def counterpart(self, title, language):
+        """Returns the title of the English page 'title' on the Wikipedia in
+        'language', or None if it has none."""
+        return self.counterparts.get(title, {}).get(
+            wikipedia_language(language)
+        )
+
+
+def normalize_wikipedia_localized(interwiki_links, wikipedia_api, language,
+                                  link_cache=None, resolved=None):
+    """Create dictionaries with the format
+
+    {
+        "title": ["alias", "alias", ...]
+    }
+
+    of the localized and missing pages the interwiki links lead to on the
+    Wikipedia in 'language'. 'resolved' holds the interwiki titles already
+    resolved there (see resolve_links), if any.
+    """
+    resolved = dict(resolved or {})
+    remaining = [title for title in interwiki_links if title not in resolved]
+    if remaining:
+        resolved.update(resolve_links(
+            remaining, localized_wikipedia(wikipedia_api, language), link_cache
+        ))
+
+    # Links leading to an interwiki title lead to the same localized page
+    for title, aliases in interwiki_links.items():
+        if title in resolved:
+            for alias in aliases:
+                resolved.setdefault(alias, resolved[title])
 
-        # All pages retrieved in the first run are English or missing
-        if "pages" in items:
-            for value in items["pages"].values():
-                if "missing" in value:
-                    missing_pages[value["title"]] = []
-                else:
-                    language_pages[value["title"]] = []
-
-        # Add resolved redirects to a page's aliases
-        if "redirects" in items:
-            for redirect in items["redirects"]:
-                for dictionary in [language_pages, missing_pages]:
-                    for page, aliases in dictionary.items():
-                        if redirect["to"] == page \
-                                and redirect["from"] not in aliases:
-                            dictionary[page].append(redirect["from"])
-
-        # Add normalized forms of the link or its aliases
-        if "normalized" in items:
-            for normal in items["normalized"]:
-                for dictionary in [language_pages, missing_pages]:
-                    for page, aliases in dictionary.items():
-                        if (normal["to"] == page or normal["to"] in aliases) \
-                                and normal["from"] not in aliases:
-                            dictionary[page].append(normal["from"])
-
-    return language_pages, missing_pages
+    return group_links(resolved, "page"), group_links(resolved, "missing")
 
 
 def wrong_wikilinks(page, language, wikilinks_normal):
-    errors = []
-    for original, aliases in wikilinks_normal.items():
-        if original.endswith("/{}".format(language)):
-            continue
-        intersection = (set(aliases) | {original}) & set(page["wikilinks"])
-        if intersection:
-            errors.extend(list(intersection))
+    errors = [
+        link for link in page["wikilinks"]
+        if link in wikilinks_normal and
+        not wikilinks_normal[link].endswith("/{}".format(language))
+    ]
 
     if errors:
         return "Links '{}' are leading to the wrong language.".format(
             "', '".join(errors)
         )
-stacked_reviews.append([wrong_wikilinks, "wikilinks_normal", "error"])
+register(wrong_wikilinks, "error", ["wikilinks_normal"])
 
 
 def wrong_wikipedia_links(page, language, wikipedia_english):
-    errors = []
-    for original, aliases in wikipedia_english.items():
-        intersection = (set(aliases) | {original}) & set(page["wikipedia"])
-        if intersection:
-            errors.extend(list(intersection))
+    errors = [link for link in page["wikipedia"] if link in wikipedia_english]
 
     if errors:
-        return "Wikipedia links '{}' are leading to the English page.".format(
+        message = "Wikipedia links '{}' are leading to the English page.".format(
             "', '".join(errors)
         )
-stacked_reviews.append([wrong_wikipedia_links, "wikipedia_english", "warning"])
+        # Localized titles are only known if resolved with Langlinks
+        localized = [
+            "'{}:{}' for '{}'".format(
+                wikipedia_language(language), wikipedia_english[link], link
+            )
+            for link in errors if wikipedia_english[link] is not None
+        ]
+        if localized:
+            message += " Localized pages: {}.".format(", ".join(localized))
+        return message
+register(wrong_wikipedia_links, "warning", ["wikipedia_english"])
 
 
 def missing_wikipedia_pages(page, language, wikipedia_missing):
-    errors = []
-    for original, aliases in wikipedia_missing.items():
-        intersection = (set(aliases) | {original}) & set(page["wikipedia"])
-        if intersection:
-            errors.extend(list(intersection))
+    errors = [link for link in page["wikipedia"] if link in wikipedia_missing]
 
     if errors:
         return "Wikipedia links '{}' don't exist.".format(
             "', '".join(errors)
         )
-stacked_reviews.append([missing_wikipedia_pages, "wikipedia_missing", "error"])
+register(missing_wikipedia_pages, "error", ["wikipedia_missing"])
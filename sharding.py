@@ -0,0 +1,344 @@
+"""Coordinator/worker mode, spreading a run over several processes or
+machines sharing a work queue.
+
+    python sharding.py coordinate queue.db    # on one machine
+    python sharding.py work queue.db          # on any number of machines
+
+The coordinator retrieves the pagelists of all languages and enqueues their
+chunks of titles as work units. Workers claim units, retrieve, parse and
+simple-review their pages and put back the reviews and what the stacked
+reviews need of each page. Once all units of a language are done, the
+coordinator merges their results, runs the stacked reviews and saves the
+results exactly like a single-process run (see main.main) would.
+
+The coordinator works on units itself while waiting, so it also works
+without any workers. Units whose worker doesn't finish them within the
+queue's lease are handed out again, and only the result of the worker they
+were handed out to last is kept.
+
+Any object with the methods of SQLiteQueue can serve as queue. SQLiteQueue
+works for processes on one machine or sharing a file system SQLite can lock
+files on.
+"""
+import argparse
+from collections import OrderedDict
+import json
+import os
+import socket
+import sqlite3
+from time import sleep, time
+
+import requests
+
+import api
+import cache
+from features import Page
+from helpers import chunker
+import main
+import results
+import review
+
+POLL_INTERVAL = 5
+
+
+class SQLiteQueue:
+    """Work queue in a SQLite database.
+
+    Args:
+      path (str): Location of the database
+      lease (float): Seconds after which a claimed unit which isn't done is
+        handed out again
+    """
+    def __init__(self, path, lease=30*60):
+        self.lease = lease
+        self.connection = sqlite3.connect(
+            path, timeout=60, isolation_level=None
+        )
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS units ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, language TEXT, "
+            "titles TEXT, worker TEXT, claimed REAL, result TEXT)"
+        )
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS options (key TEXT PRIMARY KEY, "
+            "value TEXT)"
+        )
+
+    def reset(self, options):
+        """Empties the queue for a new run with the given options (rules,
+        ...), which all workers use."""
+        with self.connection:
+            self.connection.execute("BEGIN IMMEDIATE")
+            self.connection.execute("DELETE FROM units")
+            self.connection.execute("DELETE FROM options")
+            self.connection.executemany(
+                "INSERT INTO options VALUES (?, ?)",
+                [(key, json.dumps(value)) for key, value in options.items()]
+            )
+
+    def options(self):
+        """Returns the options of the run, or None if no run was set up
+        yet."""
+        rows = self.connection.execute(
+            "SELECT key, value FROM options"
+        ).fetchall()
+        if not rows:
+            return None
+        return {key: json.loads(value) for key, value in rows}
+
+    def put(self, language, titles):
+        self.connection.execute(
+            "INSERT INTO units (language, titles) VALUES (?, ?)",
+            (language, json.dumps(titles))
+        )
+
+    def seal(self):
+        """Marks that all units were enqueued."""
+        self.connection.execute(
+            "INSERT OR REPLACE INTO options VALUES ('sealed', 'true')"
+        )
+
+    def sealed(self):
+        return self.connection.execute(
+            "SELECT 1 FROM options WHERE key = 'sealed'"
+        ).fetchone() is not None
+
+    def claim(self, worker):
+        """Claims a unit which is neither done nor claimed by a (live)
+        worker.
+
+        Returns:
+          Tuple (unit ID, language, titles), or None if there is none
+        """
+        with self.connection:
+            self.connection.execute("BEGIN IMMEDIATE")
+            row = self.connection.execute(
+                "SELECT id, language, titles FROM units "
+                "WHERE result IS NULL AND (claimed IS NULL OR claimed < ?) "
+                "ORDER BY id LIMIT 1", (time() - self.lease,)
+            ).fetchone()
+            if row is None:
+                return None
+            self.connection.execute(
+                "UPDATE units SET worker = ?, claimed = ? WHERE id = ?",
+                (worker, time(), row[0])
+            )
+        unit, language, titles = row
+        return unit, language, json.loads(titles)
+
+    def complete(self, unit, worker, result):
+        """Stores the result of a unit claimed by 'worker'. Unit IDs aren't
+        reused by later runs, so results of units of an earlier run are
+        dropped, as are those of units handed out to another worker after
+        the lease ran out.
+
+        Returns:
+          Whether the result was stored
+        """
+        cursor = self.connection.execute(
+            "UPDATE units SET result = ? "
+            "WHERE id = ? AND worker = ? AND result IS NULL",
+            (json.dumps(result), unit, worker)
+        )
+        return cursor.rowcount > 0
+
+    def remaining(self, language=None):
+        """Returns the number of units (of 'language', if given) which
+        aren't done yet."""
+        if language is None:
+            row = self.connection.execute(
+                "SELECT COUNT(*) FROM units WHERE result IS NULL"
+            ).fetchone()
+        else:
+            row = self.connection.execute(
+                "SELECT COUNT(*) FROM units "
+                "WHERE result IS NULL AND language = ?", (language,)
+            ).fetchone()
+        return row[0]
+
+    def results(self, language):
+        """Returns the results of a language's units in the order they were
+        enqueued."""
+        return [
+            json.loads(result) for result, in self.connection.execute(
+                "SELECT result FROM units WHERE language = ? ORDER BY id",
+                (language,)
+            )
+        ]
+
+    def close(self):
+        self.connection.close()
+
+
+def review_unit(language, titles, session, options):
+    """Retrieves, parses and simple-reviews the pages 'titles'.
+
+    Returns:
+      Dictionary of the form
+
+      {
+          "reviews": {title: [[rule, level, details], ...]},
+          "pages": [[title, categories, wikilinks, wikipedia], ...],
+      }
+
+      holding everything the stacked reviews need of the pages
+    """
+    rules = options["rules"]
+    wiki_api = api.API(main.TF2WIKI_API_LOCATION, session=session)
+    data, links = main.page_query(rules, options["server_links"])
+    raw_pages = [
+        page
+        for response in wiki_api.retrieve_pages(
+            titles, data, chunk_size=main.CHUNK_SIZE, delay=main.DELAY,
+            links=links
+        )
+        for page in response["query"]["pages"].values()
+    ]
+    pages, reviews = main.parse_and_review(
+        raw_pages, language, release=True, rules=rules
+    )
+    return {
+        "reviews": reviews,
+        "pages": [
+            [
+                title, page["categories"], page.get("wikilinks", []),
+                page.get("wikipedia", []),
+            ]
+            for title, page in pages.items()
+        ],
+    }
+
+
+def work(queue, session, worker=None, wait=True):
+    """Processes units of 'queue' until all are done. Unless 'wait', stops
+    as soon as there are no units left to claim instead.
+
+    Returns:
+      Number of units processed
+    """
+    worker = worker or "{}:{}".format(socket.gethostname(), os.getpid())
+    processed = 0
+    while True:
+        options = queue.options()
+        unit = queue.claim(worker) if options is not None else None
+        if unit is None:
+            if not wait or (queue.sealed() and queue.remaining() == 0):
+                return processed
+            sleep(POLL_INTERVAL)
+            continue
+
+        unit, language, titles = unit
+        print("Reviewing {} pages of '{}'".format(len(titles), language))
+        result = review_unit(language, titles, session, options)
+        if not queue.complete(unit, worker, result):
+            print("Unit {} was handed out again, dropping its result".format(
+                unit
+            ))
+            continue
+        processed += 1
+
+
+def merge(queue, language, session, rules=None, link_cache=None):
+    """Combines the results of a language's units, runs the stacked reviews
+    and saves the results."""
+    writer = results.ResultsWriter(language)
+    pages = OrderedDict()
+    for result in queue.results(language):
+        # Titles of the pagelist leading to the same page (e.g. through a
+        # redirect) may have had it reviewed in several units
+        new = {title for title, *_ in result["pages"] if title not in pages}
+        writer.add({
+            title: findings for title, findings in result["reviews"].items()
+            if title in new
+        })
+        for title, categories, wikilinks, wikipedia in result["pages"]:
+            if title not in new:
+                continue
+            pages[title] = Page(
+                title, categories=categories, wikilinks=wikilinks,
+                wikipedia=wikipedia
+            )
+
+    arguments = None
+    link_maps = review.needed_fields(rules) & set(review.LINK_MAPS)
+    if link_maps:
+        wiki_api = api.API(main.TF2WIKI_API_LOCATION, session=session)
+        wikipedia_api = api.API(
+            main.WIKIPEDIA_API_LOCATION, session=session, language="en"
+        )
+        arguments = review.resolve_arguments(
+            pages, language, wiki_api, wikipedia_api, link_cache,
+            maps=link_maps
+        )
+    writer.add(review.stacked_review(pages, language, arguments, rules))
+    for path in writer.close():
+        print("Saved", path)
+
+
+def coordinate(queue, session, rules=None, server_links=False,
+               link_cache_path=":memory:", work_too=True):
+    """Enqueues the pages of all languages as units of at most
+    main.CHUNK_SIZE (or the API's limit of) titles, waits for them to be
+    done (working on them as well, if 'work_too') and merges the results of
+    each language as soon as all of its units are done."""
+    review.plan(rules)
+    queue.reset({"rules": rules, "server_links": server_links})
+    wiki_api = api.API(main.TF2WIKI_API_LOCATION, session=session)
+    chunk_size = main.CHUNK_SIZE or wiki_api.title_limit()
+    pagelists = wiki_api.retrieve_pagelists(main.LANGUAGES)
+    for language in main.LANGUAGES:
+        for titles in chunker(pagelists[language], chunk_size):
+            queue.put(language, titles)
+    queue.seal()
+
+    if work_too:
+        work(queue, session, "coordinator", wait=False)
+
+    link_cache = cache.LinkCache(link_cache_path)
+    for language in main.LANGUAGES:
+        while queue.remaining(language):
+            sleep(POLL_INTERVAL)
+        print("Merging '{}'".format(language))
+        merge(queue, language, session, rules, link_cache)
+    link_cache.close()
+    print("All done.")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("mode", choices=["coordinate", "work"])
+    parser.add_argument("queue", help="location of the SQLite work queue")
+    parser.add_argument(
+        "--rules", metavar="NAME", nargs="+",
+        help="only run these reviews (coordinator only)"
+    )
+    parser.add_argument(
+        "--server-links", action="store_true",
+        help="retrieve the links of pages from the API instead of parsing "
+             "them, if no other review needs the content (coordinator only)"
+    )
+    parser.add_argument(
+        "--link-cache", metavar="PATH", default=":memory:",
+        help="keep resolved links in this file between runs"
+    )
+    parser.add_argument(
+        "--lease", metavar="SECONDS", type=float, default=30*60,
+        help="hand out units again if they aren't done after this long"
+    )
+    args = parser.parse_args()
+    try:
+        review.plan(args.rules)
+    except ValueError as error:
+        parser.error(str(error))
+
+    session = requests.Session()
+    session.headers["User-Agent"] = "Operation Cleanup (TidB)"
+    work_queue = SQLiteQueue(args.queue, lease=args.lease)
+    if args.mode == "coordinate":
+        coordinate(
+            work_queue, session, rules=args.rules,
+            server_links=args.server_links, link_cache_path=args.link_cache
+        )
+    else:
+        work(work_queue, session)
+    work_queue.close()
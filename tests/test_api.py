@@ -0,0 +1,304 @@
+import json
+import threading
+from urllib.parse import urlparse
+
+import pytest
+
+import api
+from fakewiki import Corpus, FakeWiki
+
+LOCATION = "http://fake/tf2/api.php"
+DATA = {
+    "action": "query",
+    "format": "json",
+    "redirects": "",
+    "prop": "revisions|categories|info",
+    "rvprop": "content|ids",
+    "cllimit": "max",
+    "inprop": "displaytitle",
+}
+TITLES = ["Article {}/de".format(number) for number in range(40)] + [
+    "Alias 10/de", "article_3/de", "Missing/de",
+]
+
+
+class Response:
+    def __init__(self, status_code, headers, content):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+
+    def json(self):
+        return json.loads(self.content.decode("utf-8"))
+
+    def iter_content(self, chunk_size=1):
+        for start in range(0, len(self.content), chunk_size):
+            yield self.content[start:start + chunk_size]
+
+
+class Session:
+    """Sends requests straight to a FakeWiki."""
+    offline = True
+
+    def __init__(self, wiki):
+        self.wiki = wiki
+
+    def get(self, url, params=None, **kwargs):
+        return Response(*self.wiki.response(urlparse(url).path, params))
+
+    def post(self, url, data=None, **kwargs):
+        return Response(*self.wiki.response(urlparse(url).path, data))
+
+
+@pytest.fixture(autouse=True)
+def no_waiting(monkeypatch):
+    monkeypatch.setattr(api.API, "BACKOFF", 0)
+    monkeypatch.setattr(api.API, "RETRY_AFTER", 0)
+
+
+def wiki_api(**options):
+    wiki = FakeWiki(Corpus(50, ["de"]), **options)
+    return api.API(LOCATION, session=Session(wiki)), wiki
+
+
+def retrieve(wiki_api, data=DATA, chunk_size=20):
+    return [
+        page
+        for response in wiki_api.retrieve_pages(
+            TITLES, data, chunk_size=chunk_size
+        )
+        for page in response["query"]["pages"].values()
+    ]
+
+
+def requests(wiki):
+    return sum(stats["requests"] for stats in wiki.stats.values())
+
+
+def test_merge_query():
+    response = {
+        "continue": {"clcontinue": "1|B"},
+        "query": {
+            "normalized": [{"from": "a", "to": "A"}],
+            "pages": {
+                "1": {"title": "A", "revisions": [{"revid": 1}],
+                      "categories": [{"title": "Category:A"}]},
+                "-1": {"title": "Missing", "missing": ""},
+            },
+        },
+    }
+    api.merge_query(response, {
+        "warnings": {"main": {"*": "Unrecognized parameter"}},
+        "query": {
+            "normalized": [{"from": "a", "to": "A"},
+                           {"from": "b", "to": "B"}],
+            "interwiki": [{"title": "w:Foo", "iw": "w"}],
+            "pages": {
+                "1": {"title": "A", "categories": [{"title": "Category:B"}]},
+                "2": {"title": "B", "categories": [{"title": "Category:A"}]},
+                "-1": {"title": "Missing", "missing": ""},
+            },
+        },
+    })
+    assert response == {
+        "continue": {"clcontinue": "1|B"},
+        "warnings": {"main": {"*": "Unrecognized parameter"}},
+        "query": {
+            "normalized": [{"from": "a", "to": "A"},
+                           {"from": "b", "to": "B"}],
+            "interwiki": [{"title": "w:Foo", "iw": "w"}],
+            "pages": {
+                "1": {"title": "A", "revisions": [{"revid": 1}],
+                      "categories": [{"title": "Category:A"},
+                                     {"title": "Category:B"}]},
+                "2": {"title": "B", "categories": [{"title": "Category:A"}]},
+                "-1": {"title": "Missing", "missing": ""},
+            },
+        },
+    }
+
+
+@pytest.mark.parametrize("options, data", [
+    ({"result_size": 5000}, DATA),
+    ({}, dict(DATA, cllimit="1")),
+    ({"result_size": 5000}, dict(DATA, cllimit="1")),
+])
+def test_continued_pages(options, data):
+    expected = retrieve(wiki_api()[0])
+    continued_api, wiki = wiki_api(**options)
+    assert retrieve(continued_api, data) == expected
+    assert requests(wiki) > 3
+
+
+def test_continued_langlinks():
+    data = {"action": "query", "format": "json", "prop": "langlinks",
+            "lllimit": "50"}
+    wikipedia = FakeWiki(Corpus(50, ["de", "fr"]))
+    wikipedia_api = api.API(
+        "http://fake/wikipedia/en/api.php", session=Session(wikipedia)
+    )
+    titles = ["Topic {}".format(number) for number in range(20)]
+    pages = {
+        page["title"]: page.get("langlinks", [])
+        for response in wikipedia_api.retrieve_pages(titles, data, 20)
+        for page in response["query"]["pages"].values()
+    }
+    assert pages == {
+        title: wikipedia.corpus.wikipedia_langlinks("en", title)
+        for title in titles
+    }
+    assert requests(wikipedia) > 2
+
+
+@pytest.mark.parametrize("options", [
+    {}, {"result_size": 5000}, {"lag_every": 2},
+])
+def test_stream_pages(options):
+    expected = retrieve(wiki_api()[0])
+    streaming_api, _ = wiki_api(**options)
+    pages = list(streaming_api.stream_pages(
+        TITLES, dict(DATA, cllimit="1"), chunk_size=20
+    ))
+    key = lambda page: page["title"]
+    assert sorted(pages, key=key) == sorted(expected, key=key)
+
+
+def test_maxlag_retried():
+    expected = retrieve(wiki_api()[0])
+    lagged_api, wiki = wiki_api(lag_every=2, result_size=5000)
+    assert retrieve(lagged_api) == expected
+    assert wiki.lag_count > requests(wiki) // 2
+
+
+def test_maxlag_gives_up():
+    lagged_api, wiki = wiki_api(lag_every=1)
+    with pytest.raises(RuntimeError, match="lagged"):
+        retrieve(lagged_api)
+    assert requests(wiki) == api.API.LAG_RETRIES
+
+
+def test_stream_error():
+    erroring_api, _ = wiki_api()
+    with pytest.raises(RuntimeError, match="badvalue"):
+        list(erroring_api.stream_pages(
+            TITLES, dict(DATA, action="parse"), chunk_size=20
+        ))
+
+
+class BlockingSession(Session):
+    """Holds POST requests until 'release' is set."""
+    def __init__(self, wiki):
+        super().__init__(wiki)
+        self.entered = threading.Event()
+        self.release = threading.Event()
+
+    def post(self, url, data=None, **kwargs):
+        self.entered.set()
+        assert self.release.wait(5)
+        return super().post(url, data, **kwargs)
+
+
+class FailingSession(Session):
+    def post(self, url, data=None, **kwargs):
+        raise RuntimeError("down")
+
+
+def wiki_api_of(languages, session=Session):
+    wiki = FakeWiki(Corpus(30, languages))
+    return api.API(LOCATION, session=session(wiki)), wiki
+
+
+@pytest.fixture
+def pool():
+    pool = api.TitlePool(["de", "fr", "ja"])
+    pool_api, _ = wiki_api_of(["de", "fr", "ja"])
+    for language in pool.languages:
+        pool.pagelist(language, pool_api)
+    return pool
+
+
+def test_pool_pagelists(pool):
+    pool_api, wiki = wiki_api_of(["de"])
+    assert pool.pagelist("de", pool_api) == [
+        "Article {}/de".format(number) for number in range(30)
+    ]
+    assert requests(wiki) == 0
+
+
+def test_pool_fill(pool):
+    pool_api, wiki = wiki_api_of(["de", "fr", "ja"])
+    pool.start("de")
+    pool.start("fr")
+    titles = pool.pagelist("de", pool_api)[-5:]
+    pages = pool.fill(titles, pool_api, DATA, chunk_size=20)
+    assert [page["title"] for page in pages] == titles
+    assert requests(wiki) == 1
+
+    # Started languages aren't used to fill up chunks
+    assert pool.take("fr", pool.pagelist("fr", pool_api)) == (
+        [], pool.pagelist("fr", pool_api)
+    )
+    pool.start("ja")
+    ja_titles = pool.pagelist("ja", pool_api)
+    taken, remaining = pool.take("ja", ja_titles)
+    assert [page["title"] for page in taken] == ja_titles[:15]
+    assert all("revisions" in page for page in taken)
+    assert remaining == ja_titles[15:]
+    # Pages are only taken once
+    assert pool.take("ja", ja_titles) == ([], ja_titles)
+
+
+def test_pool_fill_claims_once(pool):
+    pool_api, _ = wiki_api_of(["de", "fr", "ja"])
+    pool.start("de")
+    pool.fill(["Article 0/de"], pool_api, DATA, chunk_size=21)
+    pool.fill(["Article 1/de"], pool_api, DATA, chunk_size=21)
+    pool.start("fr")
+    pool.start("ja")
+    fr_pages, fr_remaining = pool.take("fr", pool.pagelist("fr", pool_api))
+    ja_pages, ja_remaining = pool.take("ja", pool.pagelist("ja", pool_api))
+    assert len(fr_pages) == 30 and fr_remaining == []
+    assert len(ja_pages) == 10 and len(ja_remaining) == 20
+
+
+def test_pool_take_waits(pool):
+    pool_api, _ = wiki_api_of(["de", "fr", "ja"], BlockingSession)
+    pool.start("de")
+    filling = threading.Thread(daemon=True, target=pool.fill, args=(
+        ["Article 0/de"], pool_api, DATA
+    ), kwargs={"chunk_size": 11})
+    filling.start()
+    assert pool_api.session.entered.wait(5)
+
+    pool.start("fr")
+    taken = []
+    taking = threading.Thread(daemon=True, target=lambda: taken.append(
+        pool.take("fr", pool.pagelist("fr", pool_api))
+    ))
+    taking.start()
+    taking.join(0.2)
+    assert taking.is_alive()
+
+    pool_api.session.release.set()
+    taking.join(5)
+    filling.join(5)
+    pages, remaining = taken[0]
+    assert len(pages) == 10 and len(remaining) == 20
+
+
+def test_pool_failed_fill(pool):
+    pool_api, _ = wiki_api_of(["de", "fr", "ja"], FailingSession)
+    pool.start("de")
+    with pytest.raises(RuntimeError, match="down"):
+        pool.fill(["Article 0/de"], pool_api, DATA, chunk_size=11)
+
+    # The claimed languages don't wait, but retrieve their titles themselves
+    pool.start("fr")
+    fr_titles = pool.pagelist("fr", pool_api)
+    taken = []
+    taking = threading.Thread(daemon=True, target=lambda: taken.append(
+        pool.take("fr", fr_titles)
+    ))
+    taking.start()
+    taking.join(5)
+    assert taken == [([], fr_titles)]
@@ -0,0 +1,148 @@
+import json
+
+import pytest
+
+from jsonstream import decode_pages
+
+RESPONSE = {
+    "continue": {"rvcontinue": "1|2", "continue": "||"},
+    "warnings": {"main": {"*": "Unrecognized parameter"}},
+    "query": {
+        "normalized": [{"from": "foo", "to": "Foo"}],
+        "pages": {
+            "12": {
+                "pageid": 12, "title": "Foo",
+                "revisions": [{"*": "{{Item infobox}} [[Bär]] \"}] \\ é€𝄞"}],
+            },
+            "-1": {"title": "Missing", "missing": ""},
+            "7": {"pageid": 7, "length": -12.5e3, "new": True, "old": None},
+        },
+        "redirects": [],
+    },
+}
+
+
+def split(body, *positions):
+    positions = [0, *positions, len(body)]
+    return [body[start:end] for start, end in zip(positions, positions[1:])]
+
+
+def decode(blocks):
+    head, *pages = decode_pages(blocks)
+    return head, pages
+
+
+def expected(response):
+    pages = list(response["query"]["pages"].items())
+    head = dict(response, query=dict(response["query"]))
+    del head["query"]["pages"]
+    return head, pages
+
+
+@pytest.mark.parametrize("ensure_ascii", [True, False])
+def test_split_at_every_byte(ensure_ascii):
+    body = json.dumps(RESPONSE, ensure_ascii=ensure_ascii).encode()
+    for position in range(len(body) + 1):
+        assert decode(split(body, position)) == expected(RESPONSE)
+
+
+def test_single_bytes():
+    body = json.dumps(RESPONSE, ensure_ascii=False).encode()
+    blocks = [body[i:i + 1] for i in range(len(body))]
+    assert decode(blocks) == expected(RESPONSE)
+
+
+@pytest.mark.parametrize("character", ["ä", "€", "𝄞"])
+def test_multibyte_character_split(character):
+    body = '{{"query": {{"pages": {{"1": "{}"}}}}}}'.format(character).encode()
+    start = body.index(character.encode())
+    for position in range(start + 1, start + len(character.encode())):
+        assert decode(split(body, position)) == ({"query": {}}, [
+            ("1", character)
+        ])
+
+
+@pytest.mark.parametrize("number", ["12345", "-0.25", "1e10", "-3E-2"])
+def test_number_at_block_end(number):
+    body = '{{"query": {{"pages": {{"1": {}}}}}}}'.format(number).encode()
+    start = body.index(number.encode())
+    for position in range(start + 1, start + len(number) + 1):
+        assert decode(split(body, position)) == ({"query": {}}, [
+            ("1", json.loads(number))
+        ])
+
+
+def test_number_at_body_end():
+    assert decode([b'{"a": 1', b"2}"]) == ({"a": 12}, [])
+
+
+def test_large_value():
+    text = '{{x}} "[[y]]" \\ é' * 100000
+    body = json.dumps({"query": {"pages": {"1": {"*": text}}}}).encode()
+    blocks = split(body, *range(1000, len(body), 1000))
+    assert decode(blocks) == ({"query": {}}, [("1", {"*": text})])
+
+
+@pytest.mark.parametrize("response", [
+    {},
+    {"batchcomplete": ""},
+    {"error": {"code": "maxlag", "info": "Waiting for a database server"}},
+    {"error": {"code": "badvalue"}, "servedby": "mw1"},
+    {"query": {"pages": []}},
+    {"query": {"general": {"case": "first-letter"}}},
+])
+def test_without_pages(response):
+    body = json.dumps(response).encode()
+    head, pages = decode(split(body, len(body) // 2))
+    assert head == response and pages == []
+
+
+def test_empty_pages():
+    assert decode([b'{"query": {"pages": {}}}']) == ({"query": {}}, [])
+
+
+def test_head_before_pages():
+    pages = decode_pages([json.dumps(RESPONSE).encode(), b"}"])
+    head = next(pages)
+    assert head["continue"] == RESPONSE["continue"]
+    assert "warnings" in head
+    with pytest.raises(ValueError):
+        list(pages)
+
+
+@pytest.mark.parametrize("body", [
+    b'{"a": 1} x',
+    b'{"a": 1}}',
+    b'{"a": 1} {"b": 2}',
+    b'{"query": {"pages": {"1": {}}}} 1',
+])
+def test_trailing_garbage(body):
+    with pytest.raises(ValueError):
+        list(decode_pages(split(body, 3)))
+
+
+@pytest.mark.parametrize("body", [
+    b'',
+    b'{',
+    b'{"query": {"pages": {"1": {"a": 1}',
+    b'{"query": {"pages": {"1": {"a": "tex',
+    b'{"query": {"pages": {"1": {"a": "\\',
+    b'{"query": {"pages": {"1": 12',
+    b'{"query": {"pages": {"1": {"a": "\xc3',
+    b'{"query": {"pages": {"1": {"a": 1}}}',
+])
+def test_truncated(body):
+    with pytest.raises(ValueError):
+        list(decode_pages(split(body, len(body) // 2)))
+
+
+@pytest.mark.parametrize("body", [
+    b'[]',
+    b'{"a" 1}',
+    b'{"a": 1,}',
+    b'{1: 2}',
+    b'{"query": {"pages": {"1": {"a": 1]}}}',
+])
+def test_invalid(body):
+    with pytest.raises(ValueError):
+        list(decode_pages([body]))
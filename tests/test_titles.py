@@ -0,0 +1,102 @@
+import pytest
+
+from titles import TitleNormalizer
+
+SITEINFO = {
+    "general": {"case": "first-letter"},
+    "namespaces": {
+        "0": {"id": 0, "case": "first-letter", "*": ""},
+        "2": {"id": 2, "case": "first-letter", "*": "User",
+              "canonical": "User"},
+        "3": {"id": 3, "case": "first-letter", "*": "User talk",
+              "canonical": "User talk"},
+        "6": {"id": 6, "case": "first-letter", "*": "Datei",
+              "canonical": "File"},
+        "14": {"id": 14, "case": "first-letter", "*": "Kategorie",
+               "canonical": "Category"},
+    },
+    "namespacealiases": [{"id": 6, "*": "Image"}],
+    "interwikimap": [
+        {"prefix": "de", "localinterwiki": ""},
+        {"prefix": "w"},
+    ],
+}
+
+
+@pytest.fixture
+def normalizer():
+    return TitleNormalizer(SITEINFO)
+
+
+@pytest.mark.parametrize("title, expected", [
+    # Spaces and first letter
+    ("foo", "Foo"),
+    ("foo_bar", "Foo bar"),
+    ("  foo   bar_ ", "Foo bar"),
+    ("ǆx", "Ǆx"),
+    # Namespaces, canonical names and aliases
+    ("file:foo.png", "Datei:Foo.png"),
+    ("FILE : foo.png", "Datei:Foo.png"),
+    ("image:foo.png", "Datei:Foo.png"),
+    ("Category:foo", "Kategorie:Foo"),
+    ("kategorie:_foo", "Kategorie:Foo"),
+    # Not a namespace
+    ("Foo:bar", "Foo:bar"),
+    # Leading colon
+    (":foo", "Foo"),
+    (": foo", "Foo"),
+    (":Category:foo", "Kategorie:Foo"),
+    # Local interwiki prefixes lead to the wiki itself
+    ("de:foo", "Foo"),
+    ("DE:Category:foo", "Kategorie:Foo"),
+])
+def test_normalized(normalizer, title, expected):
+    assert normalizer.normalize(title) == expected
+
+
+@pytest.mark.parametrize("title", [
+    # Uppercased differently by PHP and Python, or changing length
+    "ßstraße",
+    "Datei:ßx",
+    "ﬁx",
+    # Sections, entities, percent encoding and other special characters
+    "Foo#bar",
+    "#bar",
+    "Foo%20bar",
+    "Foo &amp; bar",
+    "Foo|bar",
+    "Foo[bar]",
+    "Foo\x7f",
+    # User names have rules of their own
+    "User:foo",
+    "user talk:foo",
+    # Interwiki links to other wikis
+    "w:Foo",
+    # Invalid titles
+    "",
+    " ",
+    ".foo",
+    "/foo",
+    "Foo~~~",
+    "Datei:",
+    "Datei::foo",
+    "x" * 256,
+    "é" * 128,
+])
+def test_left_to_server(normalizer, title):
+    assert normalizer.normalize(title) is None
+
+
+def test_max_length(normalizer):
+    assert normalizer.normalize("x" * 255) == "X" + "x" * 254
+
+
+def test_case_sensitive_wiki():
+    siteinfo = dict(SITEINFO, general={"case": "case-sensitive"})
+    assert TitleNormalizer(siteinfo).normalize("foo_bar") == "foo bar"
+
+
+def test_without_namespaces():
+    normalizer = TitleNormalizer({})
+    assert normalizer.normalize("foo") == "Foo"
+    assert normalizer.normalize("Foo:bar") is None
@@ -0,0 +1,106 @@
+import re
+
+# Characters MediaWiki treats like spaces in titles (and turns into
+# underscores in its database keys)
+WHITESPACE = re.compile(
+    "[ _\xa0\u1680\u180e\u2000-\u200a\u2028\u2029\u202f\u205f\u3000]+"
+)
+# Characters needing decoding or making a title invalid or a link to a
+# section, which are left to the server
+SPECIAL_CHARACTERS = frozenset("#<>[]{}|%&\u200e\u200f\ufffd")
+MAX_LENGTH = 255
+
+
+class TitleNormalizer:
+    """Normalizes titles the way the MediaWiki API does in the 'normalized'
+    block of a query, without asking it.
+
+    Only the common cases are handled: underscores and runs of spaces,
+    namespace names and aliases, local interwiki prefixes and first-letter
+    capitalization. For everything else (HTML entities, percent encoding,
+    sections, user names, interwiki links, ...) normalize returns None,
+    leaving the title to the server.
+
+    Args:
+      siteinfo (dict): 'query' block of a meta=siteinfo response with
+        siprop=general|namespaces|namespacealiases|interwikimap
+    """
+    def __init__(self, siteinfo):
+        self.case = siteinfo.get("general", {}).get("case", "first-letter")
+        self.known_namespaces = "namespaces" in siteinfo
+
+        # {lowercase name or alias: (id, local name, case)}
+        self.namespaces = {}
+        for namespace in siteinfo.get("namespaces", {}).values():
+            if namespace["id"] == 0:
+                continue
+            entry = (
+                namespace["id"], namespace["*"],
+                namespace.get("case", self.case)
+            )
+            for name in (namespace["*"], namespace.get("canonical")):
+                if name:
+                    self.namespaces[self.key(name)] = entry
+        by_id = {entry[0]: entry for entry in self.namespaces.values()}
+        for alias in siteinfo.get("namespacealiases", []):
+            if alias["id"] in by_id:
+                self.namespaces[self.key(alias["*"])] = by_id[alias["id"]]
+
+        # {lowercase prefix: whether it leads to this wiki itself}
+        self.interwiki = {
+            item["prefix"].lower(): "localinterwiki" in item
+            for item in siteinfo.get("interwikimap", [])
+        }
+
+    @staticmethod
+    def key(name):
+        return WHITESPACE.sub(" ", name).strip().lower()
+
+    def capitalize(self, name, case):
+        if case != "first-letter":
+            return name
+        first = name[0].upper()
+        if len(first) != 1:
+            # e.g. 'ß', which PHP and Python uppercase differently
+            return None
+        return first + name[1:]
+
+    def normalize(self, title):
+        """Returns the normalized form of 'title', or None if it has to be
+        normalized by the server."""
+        if any(char in SPECIAL_CHARACTERS or ord(char) < 32 or char == "\x7f"
+               for char in title):
+            return None
+
+        title = WHITESPACE.sub(" ", title).strip()
+        if title.startswith(":"):
+            title = title[1:].lstrip()
+
+        if ":" in title:
+            if not self.known_namespaces:
+                return None
+            prefix, name = title.split(":", 1)
+            prefix = self.key(prefix)
+            if prefix in self.namespaces:
+                namespace, namespace_name, case = self.namespaces[prefix]
+                if namespace in (2, 3):
+                    # User names (and IP addresses) have rules of their own
+                    return None
+                name = name.strip()
+                if not name or name.startswith(":"):
+                    return None
+                name = self.capitalize(name, case)
+                if name is None:
+                    return None
+                title = "{}:{}".format(namespace_name, name)
+                return title if len(title.encode("utf-8")) <= MAX_LENGTH \
+                    else None
+            if prefix in self.interwiki:
+                if self.interwiki[prefix]:
+                    return self.normalize(name)
+                return None
+
+        if not title or title.startswith((".", "/")) or "~~~" in title or \
+                len(title.encode("utf-8")) > MAX_LENGTH:
+            return None
+        return self.capitalize(title, self.case)